@@ -0,0 +1,96 @@
+"""
+Analysis profiles: the sampling, window sizes and acceptance cuts used by SpecFocus,
+chosen for each frame from its side, binning (BINNING keyword) and readout window.
+
+The values are given for an unbinned full frame, in unbinned pixels, and are scaled
+to the binning of the frame: a binned frame is sampled at the same places on the
+detector, with proportionally fewer pixels to measure. A windowed readout keeps
+the same line windows and cuts, but is sampled up to its edges and needs fewer
+widths per column, since it has fewer lines.
+"""
+
+# unbinned size (rows, columns) of the full mosaic of each side
+detectorShape = {'red': (4096, 4096), 'blue': (4096, 4096)}
+
+# analysis parameters of an unbinned full frame
+defaults = {'edge': 200,        # columns closer than this to the left or right edge are not sampled
+            'windowEdge': 20,   # the same for a windowed readout, where the detector edges are outside the window
+            'stride': 100,      # distance between sampled columns
+            'smooth': 20,       # sigma of the smoothing used to skip empty columns
+            'window': 68,       # length of the window around each line (rows/60 of a full frame)
+            'minWidths': 6,     # smallest number of widths for a column to be used
+            'clipHigh': 1.0,    # widths above the median + clipHigh of their column are dropped
+            'maxScatter': 1.0,  # a column is used if the standard deviation of its widths is below maxScatter
+            'maxWidth': 5.0}    # and their median below maxWidth
+
+# changes to the defaults, by (side, BINNING value); None stands for any side or binning.
+# All the matches are applied, the most specific last: (None, binning), (side, None), (side, binning).
+overrides = {}
+
+# detector setup of the focus images of each side (KTL keyword: value), written before a
+# focus loop; after the loop both sides get back the values they had before it
+# (saveDetectorState / restoreDetectorState in the GUI)
+acquisitionSetup = {'red': {'binning': [1, 1], 'pane': [0, 0, 4096, 4096]},
+                    'blue': {'numamps': 4, 'amplist': [1, 4, 0, 0], 'ccdsel': 'mosaic', 'binning': [1, 1],
+                             'window': [1, 0, 0, 2048, 4096], 'prepix': 51, 'postpix': 80}}
+
+# fast focus mode: 2x2 binned readout of the central half of the columns, all the rows,
+# for about an eighth of the pixels of the standard setup; the same keywords are written
+fastSetup = {'red': {'binning': [2, 2], 'pane': [1024, 0, 2048, 4096]},
+             'blue': {'numamps': 4, 'amplist': [1, 4, 0, 0], 'ccdsel': 'mosaic', 'binning': [2, 2],
+                      'window': [1, 512, 0, 1024, 4096], 'prepix': 51, 'postpix': 80}}
+
+
+def parseBinning(value):
+    """
+    (column binning, row binning) from a BINNING keyword such as '2,2'
+    """
+    if not value:
+        return 1, 1
+    parts = [int(x) for x in str(value).replace(' ', '').split(',')]
+    return parts[0], parts[-1]
+
+
+class AnalysisProfile:
+    '''
+    Analysis parameters of one frame, in binned pixels of that frame
+    '''
+    def __init__(self, side, binning, shape, values=None):
+        values = dict(defaults, **(values or {}))
+        bx, by = binning
+        full = detectorShape[side]
+        self.side = side
+        self.binning = binning
+        self.shape = shape
+        self.windowed = shape[0] * by < 0.95 * full[0] or shape[1] * bx < 0.95 * full[1]
+        self.edge = max(int((values['windowEdge'] if self.windowed else values['edge']) / bx), 1)
+        self.stride = max(int(values['stride'] / bx), 1)
+        self.smooth = values['smooth'] / by
+        self.window = max(int(values['window'] / by), 8)
+        rowFraction = min(shape[0] * by / full[0], 1.0)
+        self.minWidths = max(int(round(values['minWidths'] * rowFraction)), 3)
+        self.clipHigh = values['clipHigh'] / by
+        self.maxScatter = values['maxScatter'] / by
+        self.maxWidth = values['maxWidth'] / by
+
+    def __repr__(self):
+        return "AnalysisProfile(%s, binning %dx%d, %s %dx%d, columns every %d from %d, window %d, min %d widths)" % (
+            self.side, self.binning[0], self.binning[1], 'window' if self.windowed else 'full frame',
+            self.shape[0], self.shape[1], self.stride, self.edge, self.window, self.minWidths)
+
+    def columns(self):
+        '''
+        Mosaic columns to sample
+        '''
+        return list(range(self.edge, self.shape[1] - self.edge, self.stride))
+
+
+def profileFor(side, binning, shape):
+    """
+    Profile of a frame of the given side, BINNING keyword value and shape (rows, columns)
+    """
+    key = str(binning).replace(' ', '') if binning else '1,1'
+    values = {}
+    for match in ((None, key), (side, None), (side, key)):
+        values.update(overrides.get(match, {}))
+    return AnalysisProfile(side, parseBinning(binning), shape, values)
@@ -0,0 +1,249 @@
+"""
+Bulk reprocessing of archived focus sequences.
+
+Finds the rfoc/bfoc images in an archive tree, groups them into focus sequences,
+measures the widths of the sequences with a pool of processes and writes one
+summary table per night. As in SpecFocus.measureWidths, the arc lines are found
+on the first image of a sequence and the same line index is used for the others.
+The widths of each image are cached in the output directory, so an interrupted
+run continues where it stopped.
+
+Usage: python FocusArchive.py archive_dir output_dir [--workers N]
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import csv
+import fnmatch
+import hashlib
+import io
+import os
+import time
+
+import numpy as np
+
+from FocusResults import FocusResults
+
+# images more than this many seconds apart start a new sequence
+sequenceGap = 1800
+# the summary tables have these columns
+summaryColumns = ['side', 'start', 'end', 'nfiles', 'focus', 'error', 'grating', 'grism', 'dichroic', 'temperature']
+
+
+def fileInfo(fname):
+    """
+    Reads the primary header of a candidate image.
+    Returns a dictionary (file, side, night, time), or None if the image is not part of a focus sequence.
+    """
+    import astropy.io.fits as pyfits
+    from astropy.time import Time
+    try:
+        hdr = pyfits.getheader(fname, 0, ignore_missing_end=True)
+    except Exception:
+        return None
+    base = os.path.basename(fname)
+    obj = str(hdr.get('OBJECT', ''))
+    if 'focus' not in obj.lower() and not (base.startswith('rfoc') or base.startswith('bfoc')):
+        return None
+    instrument = str(hdr.get('INSTRUME', ''))
+    side = 'blue' if 'BLU' in instrument else 'red'
+    if hdr.get('BLUFOCUS' if side == 'blue' else 'REDFOCUS') is None:
+        return None
+    night = str(hdr.get('DATE-OBS', ''))[:10]
+    try:
+        if 'MJD-OBS' in hdr:
+            t = Time(float(hdr['MJD-OBS']), format='mjd').unix
+        else:
+            t = Time('%sT%s' % (night, str(hdr.get('UTC', hdr.get('UT'))))).unix
+    except Exception:
+        t = os.path.getmtime(fname)
+    if not night:
+        night = time.strftime('%Y-%m-%d', time.gmtime(t))
+    return {'file': fname, 'side': side, 'night': night, 'time': t}
+
+
+def findFocusImages(archive, patterns=('*.fits', '*.fits.gz', '*.fits.fz')):
+    """
+    Walks the archive tree and returns the fileInfo of every focus image found
+    """
+    out = []
+    for root, dirs, files in os.walk(archive):
+        dirs.sort()
+        for f in sorted(files):
+            if any(fnmatch.fnmatch(f, p) for p in patterns):
+                info = fileInfo(os.path.join(root, f))
+                if info is not None:
+                    out.append(info)
+    return out
+
+
+def groupSequences(images):
+    """
+    Groups the images by night and side, then splits them where consecutive
+    images are more than sequenceGap seconds apart.
+    Returns {night: [list of images of one sequence, ...]}
+    """
+    nights = {}
+    for im in sorted(images, key=lambda x: (x['night'], x['side'], x['time'])):
+        seqs = nights.setdefault(im['night'], [])
+        last = seqs[-1][-1] if seqs else None
+        if last is None or last['side'] != im['side'] or im['time'] - last['time'] > sequenceGap:
+            seqs.append([])
+        seqs[-1].append(im)
+    return nights
+
+
+def cacheName(cacheDir, fname, method='moment', first=None):
+    """
+    Cache file of the widths of fname, measured with method and the line index
+    of first, the first image of its sequence (fname itself by default)
+    """
+    key = '%s|%s|%s' % (os.path.abspath(fname), method, os.path.abspath(first or fname))
+    key = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return os.path.join(cacheDir, '%s_%s.npz' % (os.path.basename(fname).split('.')[0], key))
+
+
+def sequenceCaches(files, cacheDir, method='moment'):
+    return [cacheName(cacheDir, f, method, files[0]) for f in files]
+
+
+def measureSequence(files, caches, method='moment'):
+    """
+    Worker: measures the widths of the images of one sequence, with the line index
+    of the first one, and writes them to their cache files.
+    Each cache file is written under a temporary name and renamed, so that an
+    interrupted run never leaves a partial file behind.
+    """
+    import SpecFocus
+    lineIndex = None
+    total = 0
+    with contextlib.redirect_stdout(io.StringIO()):
+        for fname, cache in zip(files, caches):
+            frame = SpecFocus.readFrame(fname)
+            if frame is None:
+                results = FocusResults()
+            else:
+                results, lineIndex = SpecFocus.measureFrame(frame, lineIndex, method)
+            tmp = cache + '.tmp.npz'
+            results.save(tmp)
+            os.replace(tmp, cache)
+            total += len(results)
+    return files[0], len(files), total
+
+
+def measureAll(sequences, cacheDir, workers=None, method='moment'):
+    """
+    Measures all the sequences (lists of files) that are not fully cached yet, with a pool of processes,
+    one sequence per task. At most two tasks per worker are queued at any time, to bound the memory used.
+    """
+    todo = [seq for seq in sequences
+            if not all(os.path.exists(c) for c in sequenceCaches(seq, cacheDir, method))]
+    print("%d sequences, %d already measured" % (len(sequences), len(sequences) - len(todo)))
+    if not todo:
+        return
+    workers = workers or os.cpu_count()
+    t0 = time.time()
+    done = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        queue = iter(todo)
+        while True:
+            for seq in queue:
+                pending.add(pool.submit(measureSequence, seq, sequenceCaches(seq, cacheDir, method), method))
+                if len(pending) >= 2 * workers:
+                    break
+            if not pending:
+                break
+            finished, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for fut in finished:
+                done += 1
+                try:
+                    first, nfiles, n = fut.result()
+                except Exception as e:
+                    print("Failed: %s" % e)
+                    continue
+                print("[%d/%d %.0f s] %s: %d images, %d widths" % (done, len(todo), time.time() - t0, first, nfiles, n))
+
+
+def fitSequence(seq, cacheDir, method='moment'):
+    """
+    Fits the best focus of one sequence from the cached widths.
+    Returns a row of the summary table.
+    """
+    import SpecFocus
+    import FocusDatabase
+    results = FocusResults()
+    for cache in sequenceCaches([im['file'] for im in seq], cacheDir, method):
+        if os.path.exists(cache):
+            results.extend(FocusResults.load(cache))
+    focus, error = np.nan, np.nan
+    if len(results.focusValues()) >= 3:
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                pairs = results.pairs()
+                funcV, m0, b0, focus = SpecFocus.fitPairs(pairs)
+                error = SpecFocus.minXError(pairs)
+        except (ValueError, ZeroDivisionError, np.linalg.LinAlgError):
+            pass
+    info = FocusDatabase.headerInfo(seq[-1]['file'])
+    return {'side': seq[0]['side'],
+            'start': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(seq[0]['time'])),
+            'end': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(seq[-1]['time'])),
+            'nfiles': len(seq), 'focus': focus, 'error': error,
+            'grating': info['grating'], 'grism': info['grism'], 'dichroic': info['dichroic'],
+            'temperature': info['temperature']}
+
+
+def writeSummary(fname, rows):
+    tmp = fname + '.tmp'
+    with open(tmp, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=summaryColumns)
+        writer.writeheader()
+        writer.writerows(rows)
+    os.replace(tmp, fname)
+
+
+def reprocess(archive, outdir, workers=None, method='moment', force=False):
+    """
+    Reprocesses all the focus sequences of an archive tree.
+    Nights that already have a summary table are skipped unless force is set.
+    The summary of a night is written only once all its sequences are measured,
+    so a night with a failed sequence is tried again on the next run.
+    """
+    cacheDir = os.path.join(outdir, 'cache')
+    os.makedirs(cacheDir, exist_ok=True)
+    nights = groupSequences(findFocusImages(archive))
+    summaries = {}
+    sequences = []
+    for night, seqs in sorted(nights.items()):
+        summary = os.path.join(outdir, 'focus_%s.csv' % night)
+        if os.path.exists(summary) and not force:
+            continue
+        summaries[night] = summary
+        sequences += [[im['file'] for im in seq] for seq in seqs]
+    print("%d nights to process" % len(summaries))
+    measureAll(sequences, cacheDir, workers, method)
+    for night, summary in summaries.items():
+        missing = [seq for seq in nights[night]
+                   if not all(os.path.exists(c) for c in sequenceCaches([im['file'] for im in seq], cacheDir, method))]
+        if missing:
+            print("%s: %d sequences not measured, no summary written" % (night, len(missing)))
+            continue
+        rows = [fitSequence(seq, cacheDir, method) for seq in nights[night]]
+        writeSummary(summary, rows)
+        print("%s: %d sequences written to %s" % (night, len(rows), summary))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reprocess archived LRIS focus sequences")
+    parser.add_argument('archive', help="root of the archive tree")
+    parser.add_argument('outdir', help="directory for the summary tables and the cache")
+    parser.add_argument('--workers', type=int, default=None, help="number of processes (default: all cores)")
+    parser.add_argument('--gaussian', action='store_true', help="measure widths with Gaussian line fits")
+    parser.add_argument('--force', action='store_true', help="reprocess nights that already have a summary")
+    args = parser.parse_args()
+    reprocess(args.archive, args.outdir, args.workers, 'gaussian' if args.gaussian else 'moment', args.force)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+import collections
+
+import numpy as np
+
+import SpecFocus
+
+
+class FocusCurve:
+    '''
+    One analyzed focus sequence, reduced to what the plot needs: the median
+    width at each focus value and the fitted hyperbola, sampled once.
+    The widths themselves are not kept, so a curve is small and can be
+    redrawn any number of times without refitting or reading the images again.
+    '''
+    def __init__(self, label, side, pairs, fit=None, nModel=100, padding=0.1):
+        """
+        fit is the result of SpecFocus.fitPairs(pairs), if it is already known
+        """
+        self.label = label
+        self.side = side
+        self.visible = True
+        self.x, self.y = SpecFocus.aggregatePairs(pairs)
+        self.funcV, self.m0, self.b0, self.minX = fit if fit is not None else SpecFocus.fitPairs(pairs)
+        span = (self.x.max() - self.x.min()) * padding
+        self.modelX = np.linspace(self.x.min() - span, self.x.max() + span, nModel)
+        self.modelY = self.funcV(self.modelX)
+
+    def __repr__(self):
+        return "FocusCurve(%s, %s, focus %.3f)" % (self.label, self.side, self.minX)
+
+    @classmethod
+    def fromResults(cls, label, results):
+        '''
+        Curve of a FocusResults store (from measureWidths, or loaded from an .npz file)
+        '''
+        import FocusResults
+        side = FocusResults.SIDES[int(results.side[0])] if len(results) else 'red'
+        return cls(label, side, results.pairs())
+
+
+class FocusCurves:
+    '''
+    Bounded collection of FocusCurve, by label. When more than maxCurves are
+    added, the oldest ones are dropped.
+    '''
+    def __init__(self, maxCurves=8):
+        self.maxCurves = maxCurves
+        self.curves = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.curves)
+
+    def __iter__(self):
+        return iter(self.curves.values())
+
+    def __getitem__(self, label):
+        return self.curves[label]
+
+    def add(self, curve):
+        '''
+        Adds (or replaces) a curve, returns the labels of the curves dropped to make room
+        '''
+        self.curves.pop(curve.label, None)
+        self.curves[curve.label] = curve
+        dropped = []
+        while len(self.curves) > self.maxCurves:
+            dropped.append(self.curves.popitem(last=False)[0])
+        return dropped
+
+    def visible(self, side=None):
+        return [c for c in self.curves.values() if c.visible and (side is None or c.side == side)]
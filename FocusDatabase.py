@@ -0,0 +1,130 @@
+import hashlib
+import os
+import sqlite3
+import time
+
+# primary header keywords describing the optical configuration
+configKeywords = {'grating': 'GRANAME', 'grism': 'GRISNAME', 'dichroic': 'DICHNAME'}
+# temperature keywords, the first one found in the header is recorded
+temperatureKeywords = ['TEMPDET', 'WXDOMTMP', 'WXOUTTMP']
+# the configuration that matters for the focus of each side
+sideConfig = {'red': ['grating', 'dichroic'], 'blue': ['grism', 'dichroic']}
+
+
+def headerInfo(fname):
+    """
+    Reads the optical configuration and temperature from the primary header of a focus image.
+    Returns a dictionary with the keys of configKeywords, plus temperature and tempkey.
+    """
+    import astropy.io.fits as pyfits
+    hdr = pyfits.getheader(fname, 0, ignore_missing_end=True)
+    info = {}
+    for key, kwd in configKeywords.items():
+        value = hdr.get(kwd)
+        info[key] = None if value is None else str(value).strip()
+    info['temperature'] = None
+    info['tempkey'] = None
+    for kwd in temperatureKeywords:
+        try:
+            info['temperature'] = float(hdr[kwd])
+            info['tempkey'] = kwd
+            break
+        except (KeyError, ValueError, TypeError):
+            continue
+    return info
+
+
+def fileSetKey(files):
+    """
+    Key of a set of images, independent of their order
+    """
+    names = sorted(os.path.abspath(f) for f in files)
+    return hashlib.sha1('\n'.join(names).encode()).hexdigest()
+
+
+class FocusDatabase:
+    '''
+    SQLite history of the focus fits, used to predict the starting point of the next focus loop.
+    '''
+    def __init__(self, fname='LRIS_Focus_History.sqlite'):
+        self.fname = fname
+        self.db = sqlite3.connect(fname, check_same_thread=False)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS fits (
+                               id INTEGER PRIMARY KEY,
+                               side TEXT NOT NULL,
+                               focus REAL NOT NULL,
+                               error REAL,
+                               grating TEXT,
+                               grism TEXT,
+                               dichroic TEXT,
+                               temperature REAL,
+                               tempkey TEXT,
+                               nfiles INTEGER,
+                               fileset TEXT,
+                               timestamp REAL NOT NULL)''')
+        # histories written before the file sets were recorded
+        if 'fileset' not in [row[1] for row in self.db.execute('PRAGMA table_info(fits)')]:
+            self.db.execute('ALTER TABLE fits ADD COLUMN fileset TEXT')
+        self.db.execute('CREATE INDEX IF NOT EXISTS fits_red ON fits (side, grating, dichroic, timestamp)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS fits_blue ON fits (side, grism, dichroic, timestamp)')
+        self.db.commit()
+
+    def record(self, side, focus, error, info, nfiles=None, timestamp=None, files=None):
+        '''
+        Adds a focus fit. info is the dictionary returned by headerInfo.
+        If files (the images of the fit) are given and the same set of images
+        is already in the history, nothing is added, so that re-measuring a
+        sequence does not weigh it more in predict.
+        Returns True if the fit was added.
+        '''
+        if timestamp is None:
+            timestamp = time.time()
+        fileset = fileSetKey(files) if files else None
+        if fileset is not None and self.db.execute('SELECT 1 FROM fits WHERE side = ? AND fileset = ?',
+                                                   (side, fileset)).fetchone():
+            return False
+        self.db.execute('INSERT INTO fits (side, focus, error, grating, grism, dichroic, temperature, tempkey, nfiles, fileset, timestamp) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (side, float(focus), None if error is None else float(error),
+                         info.get('grating'), info.get('grism'), info.get('dichroic'),
+                         info.get('temperature'), info.get('tempkey'), nfiles, fileset, timestamp))
+        self.db.commit()
+        return True
+
+    def history(self, side, info=None, limit=10):
+        '''
+        Returns the most recent (focus, error, temperature, timestamp) for a side,
+        restricted to the configuration in info when given
+        '''
+        query = 'SELECT focus, error, temperature, timestamp FROM fits WHERE side = ?'
+        args = [side]
+        if info:
+            for key in sideConfig[side]:
+                if info.get(key) is not None:
+                    query += ' AND %s = ?' % key
+                    args.append(info[key])
+        query += ' ORDER BY timestamp DESC LIMIT ?'
+        args.append(limit)
+        return self.db.execute(query, args).fetchall()
+
+    def predict(self, side, info=None, limit=10):
+        '''
+        Predicts the best focus from the recent history.
+        Returns (focus, scatter, number of fits used), or None if there is no history.
+        scatter is the standard deviation of the recent fits, or the error of the only fit.
+        '''
+        rows = self.history(side, info, limit)
+        if not rows:
+            return None
+        values = sorted(r[0] for r in rows)
+        n = len(values)
+        median = values[n//2] if n % 2 else (values[n//2-1] + values[n//2]) / 2
+        if n > 1:
+            mean = sum(values) / n
+            scatter = (sum((v - mean) ** 2 for v in values) / (n - 1)) ** 0.5
+        else:
+            scatter = rows[0][1]
+        return median, scatter, n
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,146 @@
+"""
+Streaming version of SpecFocus.measureWidths.
+
+A reader thread reads the frames (SpecFocus.readFrame) into a bounded queue, a pool
+of processes measures them (SpecFocus.measureFrame), and the results are handed to
+a callback as soon as each frame is done, so that the caller (the GUI) can refit
+and replot while the next frames are still being read and measured.
+Reading frame N+1 overlaps measuring frame N, and at most maxResident frames
+wait in the queue, plus one per worker being measured.
+The worker processes are started once (getPool, or warmUp in the background)
+and reused by every call.
+"""
+import concurrent.futures
+import concurrent.futures.process
+import contextlib
+import io
+import multiprocessing
+import queue
+import threading
+
+from FocusResults import FocusResults
+
+# process pools by number of workers, kept for the life of the program
+pools = {}
+
+
+def getPool(workers=2):
+    """
+    Pool of workers processes, created on the first call and reused afterwards.
+    The processes are started with forkserver, not forked from the
+    (multithreaded) calling process.
+    """
+    pool = pools.get(workers)
+    if pool is None:
+        context = multiprocessing.get_context('forkserver')
+        pool = pools[workers] = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context)
+    return pool
+
+
+def _load():
+    import SpecFocus
+    SpecFocus.preload()
+
+
+def warmUp(workers=2):
+    """
+    Starts the worker processes of getPool(workers) and imports the analysis
+    modules in them, so that the first analysis does not pay for it
+    """
+    pool = getPool(workers)
+    for fut in [pool.submit(_load) for i in range(workers)]:
+        fut.result()
+
+
+def _measure(frame, lineIndex, method, kernel):
+    # runs in a worker process, its output is not wanted
+    import SpecFocus
+    with contextlib.redirect_stdout(io.StringIO()):
+        return SpecFocus.measureFrame(frame, lineIndex, method, kernel)
+
+
+def _reader(files, frames, stop, previewFile):
+    # puts (frame, None) for every frame, then (None, None) at the end,
+    # or (None, exception) if a file cannot be read
+    import SpecFocus
+    error = None
+    try:
+        for f in files:
+            if stop.is_set():
+                break
+            frame = SpecFocus.readFrame(f, previewFactor=8 if f == previewFile else None)
+            if frame is not None:
+                frames.put((frame, None))
+    except Exception as e:
+        error = e
+    finally:
+        frames.put((None, error))
+
+
+def runPipeline(files, method='moment', kernel='reference', workers=2, maxResident=2, callback=None, preview=None):
+    """
+    Measures files like SpecFocus.measureWidths and returns the FocusResults.
+    callback(frameResults) is called from the calling thread after each frame.
+    The line index is built from the first frame, then the other frames are measured in parallel.
+    If preview is a dictionary, it is filled as in measureWidths.
+    A file that cannot be read or measured raises its exception, as in measureWidths.
+    The frames are measured in getPool(workers).
+    """
+    import SpecFocus
+    results = FocusResults()
+    frames = queue.Queue(maxsize=maxResident)
+    stop = threading.Event()
+    reader = threading.Thread(target=_reader, args=(files, frames, stop, files[-1] if preview is not None and files else None),
+                              daemon=True)
+    reader.start()
+
+    def collect(frameResults, frame):
+        results.extend(frameResults)
+        if preview is not None and 'pyramid' in frame:
+            preview.update(SpecFocus.previewInfo(frame, lineIndex))
+        if callback:
+            callback(frameResults)
+
+    pending = {}
+    try:
+        # the first frame defines the line index for all the others
+        lineIndex = None
+        first, error = frames.get()
+        if error is not None:
+            raise error
+        if first is None:
+            return results
+        frameResults, lineIndex = SpecFocus.measureFrame(first, None, method, kernel)
+        collect(frameResults, first)
+
+        pool = getPool(workers)
+        while True:
+            frame, error = frames.get()
+            if error is not None:
+                raise error
+            if frame is not None:
+                pending[pool.submit(_measure, frame, lineIndex, method, kernel)] = frame
+            if pending and (frame is None or len(pending) >= workers):
+                done, notDone = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for fut in done:
+                    collect(fut.result()[0], pending.pop(fut))
+            if frame is None:
+                for fut in concurrent.futures.as_completed(list(pending)):
+                    collect(fut.result()[0], pending.pop(fut))
+                break
+    except concurrent.futures.process.BrokenProcessPool:
+        # a worker died: the next call starts a new pool
+        pools.pop(workers, None)
+        raise
+    finally:
+        # the pool is shared: do not leave work of this call in it
+        for fut in pending:
+            fut.cancel()
+        stop.set()
+        # unblock the reader if it is waiting on a full queue
+        while reader.is_alive():
+            try:
+                frames.get(timeout=0.1)
+            except queue.Empty:
+                pass
+    return results
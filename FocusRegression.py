@@ -0,0 +1,320 @@
+"""
+Regression check of the fast analysis paths against the reference SpecFocus.
+
+Every analysis mode is run over a corpus of focus sequences: synthetic sequences
+with a known best focus, written on the fly, and recorded sequences found in
+archive directories. For each sequence, the time spent reading, measuring and
+fitting is compared with the reference mode (reference centroid, sequential
+measureWidths), along with the number of widths, the largest change of the
+median width of a sampled column and the best focus.
+A mode fails when its best focus moves by more than the tolerance from the
+reference; the exit status is then 1, so a mode can be validated before it is
+enabled at the telescope.
+
+Usage: python FocusRegression.py [dir ...] [--synthetic N] [--tolerance T] [--modes table,pipeline]
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from FocusResults import FocusResults
+
+# name: (centroid kernel, path, width estimator). The path is the sequential
+# measureWidths, the streaming FocusPipeline, the per-amplifier measureWidthsPerAmp,
+# or the sequential path without the cosmic ray masking and the line index (blind
+# segments, as before they were added), to see what they change. Every mode is
+# compared with the reference, which measures with centroid moments.
+modes = {'reference': ('reference', 'sequential', 'moment'),
+         'table': ('table', 'sequential', 'moment'),
+         'pipeline': ('reference', 'pipeline', 'moment'),
+         'table-pipeline': ('table', 'pipeline', 'moment'),
+         'amps': ('reference', 'amps', 'moment'),
+         'blind': ('reference', 'blind', 'moment'),
+         'gaussian': ('reference', 'sequential', 'gaussian')}
+
+# default tolerance on the best focus, as a fraction of the focus step of the sequence
+stepTolerance = 0.1
+
+
+def writeSynthetic(fname, focus, side='red', best=0.0, seed=0, rows=2048, ampWidth=512, nAmps=4,
+                   defocus=40.0, width=1.5, tilt=(0.0, 0.0), cosmics=0, saturation=None, compress=False, binning='1,1',
+                   detOffset=(0, 0)):
+    """
+    Writes an LRIS-like arc frame: nAmps extensions, every other one flipped
+    left/right through DETSEC, with prescan and overscan columns.
+    The lines get wider as sqrt(width^2 + (defocus * (focus - best))^2) unbinned
+    pixels, where best can be tilted by tilt (focus units per unbinned pixel in x and y).
+    The same 45 lines are used for every frame; seed only changes the noise.
+    With binning, the frame is drawn in unbinned pixels and summed over the bins:
+    rows and ampWidth are the binned size, DETSEC is in unbinned pixels.
+    detOffset (x, y) moves the frame on the detector (DETSEC), like a windowed readout.
+    """
+    import astropy.io.fits as pyfits
+    rng = np.random.default_rng(seed)
+    precol, postpix = 10, 20
+    bx, by = [int(v) for v in binning.split(',')]
+    hdr = pyfits.Header()
+    hdr['INSTRUME'] = 'LRISBLUE' if side == 'blue' else 'LRIS'
+    hdr['BLUFOCUS' if side == 'blue' else 'REDFOCUS'] = focus
+    hdr['BINNING'] = binning
+    # the header gives the prescan and overscan in unbinned pixels
+    hdr['PRECOL'] = precol * bx
+    hdr['POSTPIX'] = postpix * bx
+    hdr['PRELINE'] = 0
+    hdr['POSTLINE'] = 0
+    hdr['OBJECT'] = 'Focus loop'
+    hdus = [pyfits.PrimaryHDU(header=hdr)]
+    # unbinned size of an amplifier
+    uRows, uWidth = rows * by, ampWidth * bx
+    spectrum = np.random.default_rng(123)
+    lines = np.sort(spectrum.uniform(40 * by, uRows - 40 * by, 45))
+    heights = spectrum.uniform(500, 8000, 45) / (bx * by)
+    y = np.arange(uRows)[:, None]
+    for a in range(nAmps):
+        x0 = a * uWidth
+        x = x0 + np.arange(uWidth)[None, :]
+        bestHere = best + tilt[0] * (x - nAmps * uWidth / 2) + tilt[1] * (y - uRows / 2)
+        sigma = np.broadcast_to(np.sqrt(width ** 2 + (defocus * (focus - bestHere)) ** 2), (uRows, uWidth))
+        reach = int(8 * sigma.max()) + 1
+        img = np.zeros((uRows, uWidth)) + 1000 / (bx * by)
+        for line, height in zip(lines, heights):
+            lo, hi = max(int(line) - reach, 0), min(int(line) + reach, uRows)
+            img[lo:hi] += height * np.exp(-0.5 * ((y[lo:hi] - line) / sigma[lo:hi]) ** 2)
+        img = img.reshape(rows, by, ampWidth, bx).sum(axis=(1, 3))
+        img += rng.normal(0, 5, img.shape)
+        for c in range(cosmics):
+            cy, cx = rng.integers(0, rows), rng.integers(0, ampWidth)
+            img[cy:cy + rng.integers(1, 3), cx] += rng.uniform(2000, 30000)
+        if saturation:
+            img = np.minimum(img, saturation)
+        flip = a % 2 == 1
+        if flip:
+            img = img[:, ::-1]
+        full = 1000 + rng.normal(0, 5, (rows, precol + ampWidth + postpix))
+        full[:, precol:precol + ampWidth] = img
+        h = pyfits.Header()
+        d = (x0 + uWidth, x0 + 1) if flip else (x0 + 1, x0 + uWidth)
+        dx, dy = detOffset
+        h['DETSEC'] = '[%d:%d,%d:%d]' % (d[0] + dx, d[1] + dx, dy + 1, dy + uRows)
+        if saturation:
+            h['SATURATE'] = saturation
+        data = full.astype(np.uint16)
+        hdus.append(pyfits.CompImageHDU(data, header=h) if compress else pyfits.ImageHDU(data, header=h))
+    pyfits.HDUList(hdus).writeto(fname, overwrite=True)
+
+
+# synthetic sequences: side, best focus, focus step, defocus, writeSynthetic options
+syntheticVariants = [('red', -0.6, 0.05, 40.0, {}),
+                     ('red', -0.45, 0.05, 40.0, {'cosmics': 300, 'saturation': 6000}),
+                     ('blue', -3800.0, 20.0, 0.1, {'tilt': (0.002, 0.0), 'compress': True}),
+                     ('red', -0.55, 0.05, 20.0, {'binning': '2,2', 'rows': 1024, 'ampWidth': 256}),
+                     ('red', -0.5, 0.05, 40.0, {'nAmps': 2, 'detOffset': (1024, 512)}),
+                     ('red', -0.65, 0.05, 40.0, {'width': 0.8}),
+                     ('red', -0.4, 0.05, 40.0, {'width': 1.0, 'cosmics': 300})]
+
+
+def syntheticCorpus(directory, count=len(syntheticVariants)):
+    """
+    Writes count synthetic sequences of 7 frames in directory, cycling through
+    syntheticVariants: a clean red sequence, a red sequence with cosmic rays and
+    saturated lines, a tilted, tile-compressed blue sequence, a 2x2 binned red
+    sequence, a red window of two amplifiers offset on the detector, and two red
+    sequences with sharp lines (sigma 1 pixel or less at best focus), one of them
+    with cosmic rays.
+    Returns a list of (name, files, true best focus).
+    """
+    corpus = []
+    for k in range(count):
+        side, best, step, defocus, extra = syntheticVariants[k % len(syntheticVariants)]
+        best += k // len(syntheticVariants) * step / 3
+        prefix = 'rfoc' if side == 'red' else 'bfoc'
+        ext = '.fits.fz' if extra.get('compress') else '.fits'
+        files = []
+        for i in range(7):
+            fname = os.path.join(directory, 'synth%d_%s_%04d%s' % (k, prefix, i + 1, ext))
+            writeSynthetic(fname, best + (i - 3) * step, side, best=best, seed=100 * k + i, defocus=defocus, **extra)
+            files.append(fname)
+        corpus.append(('synthetic%d-%s' % (k, side), files, best))
+    return corpus
+
+
+def recordedCorpus(directories):
+    """
+    Focus sequences found in archive directories, grouped as FocusArchive does.
+    Returns a list of (name, files, None).
+    """
+    import FocusArchive
+    corpus = []
+    for directory in directories:
+        nights = FocusArchive.groupSequences(FocusArchive.findFocusImages(directory))
+        for night, seqs in sorted(nights.items()):
+            for i, seq in enumerate(seqs):
+                if len(seq) >= 3:
+                    corpus.append(('%s-%s-%d' % (night, seq[0]['side'], i + 1), [im['file'] for im in seq], None))
+    return corpus
+
+
+def fitFocus(results):
+    """
+    Best focus of a FocusResults, nan if it cannot be fitted
+    """
+    import SpecFocus
+    if len(results.focusValues()) < 3:
+        return np.nan
+    try:
+        return float(SpecFocus.fitPairs(results.pairs())[3])
+    except (ValueError, ZeroDivisionError, np.linalg.LinAlgError):
+        return np.nan
+
+
+def runMode(files, kernel, path, method='moment'):
+    """
+    Measures and fits a sequence in one mode.
+    Returns a dictionary with the results, the best focus, and the seconds spent
+    in each stage: read, measure, fit and total. In the streaming pipeline and the
+    per-amplifier path reading and measuring are interleaved, so only their sum is
+    known (read is nan).
+    """
+    import SpecFocus
+    import FocusPipeline
+    timing = {'read': 0.0, 'measure': 0.0}
+    t0 = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        if path == 'pipeline':
+            results = FocusPipeline.runPipeline(files, method, kernel=kernel)
+            timing['read'] = np.nan
+            timing['measure'] = time.perf_counter() - t0
+        elif path == 'amps':
+            results = SpecFocus.measureWidthsPerAmp(files, method, kernel=kernel)
+            timing['read'] = np.nan
+            timing['measure'] = time.perf_counter() - t0
+        else:
+            results = FocusResults()
+            lineIndex = None
+            for f in files:
+                t = time.perf_counter()
+                frame = SpecFocus.readFrame(f)
+                timing['read'] += time.perf_counter() - t
+                if frame is None:
+                    continue
+                t = time.perf_counter()
+                res, lineIndex = SpecFocus.measureFrame(frame, lineIndex, method, kernel, blind=path == 'blind')
+                results.extend(res)
+                timing['measure'] += time.perf_counter() - t
+        t = time.perf_counter()
+        minX = fitFocus(results)
+        timing['fit'] = time.perf_counter() - t
+    timing['total'] = time.perf_counter() - t0
+    return dict(timing, results=results, minX=minX)
+
+
+def columnMedians(results):
+    """
+    Median width of every (file, column) of a FocusResults
+    """
+    out = {}
+    keys = np.stack([results.fileIndex, results.column], axis=1)
+    for fileIndex, column in np.unique(keys, axis=0):
+        sel = (results.fileIndex == fileIndex) & (results.column == column)
+        out[(os.path.basename(results.files[fileIndex]), int(column))] = float(np.median(results.width[sel]))
+    return out
+
+
+def compare(reference, run):
+    """
+    Differences of a run from the reference run of the same sequence:
+    widths (number of widths), columns (sampled columns measured in only one of them,
+the per-amplifier path skips the columns next to the amplifier seams),
+    widthDelta (largest change of the median width of a column), minXDelta.
+    """
+    ref = columnMedians(reference['results'])
+    new = columnMedians(run['results'])
+    common = set(ref) & set(new)
+    return {'widths': len(run['results']),
+            'columns': len(set(ref) ^ set(new)),
+            'widthDelta': max([abs(ref[k] - new[k]) for k in common], default=0.0),
+            'minXDelta': run['minX'] - reference['minX']}
+
+
+def focusStep(results):
+    values = results.focusValues()
+    if len(values) < 2:
+        return np.nan
+    return float(np.median(np.diff(values)))
+
+
+def checkSequence(name, files, truth=None, names=None, tolerance=None):
+    """
+    Runs the reference and the other modes on one sequence, prints a report
+    and returns the names of the modes that moved the best focus by more than tolerance
+    (by default stepTolerance times the focus step of the sequence).
+    """
+    names = [n for n in (names or modes) if n != 'reference']
+    # warm up the file cache, so that the first mode does not pay for it
+    for f in files:
+        with open(f, 'rb') as fh:
+            while fh.read(1 << 20):
+                pass
+    reference = runMode(files, *modes['reference'])
+    if tolerance is None:
+        tolerance = stepTolerance * abs(focusStep(reference['results']))
+    print("\n%s: %d files, reference focus %.4f%s, tolerance %.4g" %
+          (name, len(files), reference['minX'], '' if truth is None else ' (true %.4f)' % truth, tolerance))
+    print("%-16s %8s %8s %8s %8s %8s %7s %7s %9s %10s %10s  %s" %
+          ('mode', 'read', 'measure', 'fit', 'total', 'speedup', 'widths', 'columns', 'dWidth', 'focus', 'dFocus', 'status'))
+    row = "%-16s %8.3f %8.3f %8.3f %8.3f %8.2f %7d %7d %9.4f %10.4f %10.4g  %s"
+    print(row % ('reference', reference['read'], reference['measure'], reference['fit'], reference['total'], 1.0,
+                 len(reference['results']), 0, 0.0, reference['minX'], 0.0, '-'))
+    failed = []
+    for n in names:
+        run = runMode(files, *modes[n])
+        diff = compare(reference, run)
+        moved = abs(diff['minXDelta'])
+        ok = moved <= tolerance or (np.isnan(run['minX']) and np.isnan(reference['minX']))
+        if not ok:
+            failed.append(n)
+        print(row % (n, run['read'], run['measure'], run['fit'], run['total'], reference['total'] / run['total'],
+                     diff['widths'], diff['columns'], diff['widthDelta'], run['minX'], diff['minXDelta'],
+                     'ok' if ok else 'FAIL'))
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the fast analysis modes with the reference SpecFocus")
+    parser.add_argument('directories', nargs='*', help="archive directories with recorded focus sequences")
+    parser.add_argument('--synthetic', type=int, default=len(syntheticVariants),
+                        help="number of synthetic sequences (default %d)" % len(syntheticVariants))
+    parser.add_argument('--modes', default=','.join(n for n in modes if n != 'reference'),
+                        help="modes to check, from %s" % ', '.join(modes))
+    parser.add_argument('--tolerance', type=float, default=None,
+                        help="largest accepted change of the best focus (default: %g focus steps)" % stepTolerance)
+    args = parser.parse_args()
+    names = args.modes.split(',')
+    unknown = [n for n in names if n not in modes]
+    if unknown:
+        parser.error("unknown modes: %s" % ', '.join(unknown))
+
+    if any(modes[n][1] == 'pipeline' for n in names):
+        # the pipeline workers are started once, when the GUI starts: not timed
+        import FocusPipeline
+        FocusPipeline.warmUp()
+
+    failures = []
+    with tempfile.TemporaryDirectory() as tmp:
+        corpus = syntheticCorpus(tmp, args.synthetic) + recordedCorpus(args.directories)
+        for name, files, truth in corpus:
+            failures += ['%s/%s' % (name, n) for n in checkSequence(name, files, truth, names, args.tolerance)]
+    if failures:
+        print("\nBest focus moved beyond the tolerance: %s" % ', '.join(failures))
+        sys.exit(1)
+    print("\nAll the modes agree with the reference")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+import numpy as np
+
+SIDES = ['red', 'blue']
+
+class FocusResults:
+    '''
+    Columnar store for the widths measured by SpecFocus.measureWidths.
+
+    Every measurement is one entry in a set of typed arrays that grow by doubling.
+    The properties return views on the filled part of the arrays, so they can be
+    given to the fitting and plotting code without copies.
+    '''
+    columns = [('focus',  np.float64),
+               ('width',  np.float32),
+               ('row',    np.float32),
+               ('column', np.int32),
+               ('amp',    np.int16),
+               ('fileIndex', np.int16),
+               ('side',   np.int8)]
+
+    def __init__(self, capacity=4096):
+        self.n = 0
+        self.files = []
+        self.arrays = {}
+        for name, dtype in self.columns:
+            self.arrays[name] = np.empty(capacity, dtype=dtype)
+
+    def __len__(self):
+        return self.n
+
+    def __repr__(self):
+        return "FocusResults(%d widths, %d files, focus values %s)" % (self.n, len(self.files), str(self.focusValues()))
+
+    def __getattr__(self, name):
+        arrays = self.__dict__.get('arrays')
+        if arrays is not None and name in arrays:
+            return arrays[name][:self.n]
+        raise AttributeError(name)
+
+    def _grow(self, needed):
+        capacity = len(self.arrays['focus'])
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        for name, dtype in self.columns:
+            arr = np.empty(capacity, dtype=dtype)
+            arr[:self.n] = self.arrays[name][:self.n]
+            self.arrays[name] = arr
+
+    def addFile(self, fname):
+        '''
+        Registers a file, returns its index to be used with append
+        '''
+        self.files.append(fname)
+        return len(self.files) - 1
+
+    def append(self, focus, widths, rows, column, amp, fileIndex, side):
+        '''
+        Adds the widths measured along one column of one file
+        '''
+        k = len(widths)
+        self._grow(self.n + k)
+        sl = slice(self.n, self.n + k)
+        self.arrays['focus'][sl] = focus
+        self.arrays['width'][sl] = widths
+        self.arrays['row'][sl] = rows
+        self.arrays['column'][sl] = column
+        self.arrays['amp'][sl] = amp
+        self.arrays['fileIndex'][sl] = fileIndex
+        self.arrays['side'][sl] = SIDES.index(side)
+        self.n += k
+
+    def extend(self, other):
+        '''
+        Appends all the measurements of another FocusResults
+        '''
+        offset = len(self.files)
+        self.files += other.files
+        k = len(other)
+        self._grow(self.n + k)
+        for name, dtype in self.columns:
+            self.arrays[name][self.n:self.n + k] = getattr(other, name)
+        self.arrays['fileIndex'][self.n:self.n + k] += offset
+        self.n += k
+
+    def pairs(self):
+        '''
+        Returns the (focus, width) views used by fitPairs and the plot
+        '''
+        return self.focus, self.width
+
+    def focusValues(self):
+        return np.unique(self.focus)
+
+    def save(self, fname):
+        '''
+        Writes the results to a compressed numpy (.npz) file
+        '''
+        data = {}
+        for name, dtype in self.columns:
+            data[name] = getattr(self, name)
+        np.savez_compressed(fname, files=np.array(self.files, dtype=str), **data)
+
+    def toDict(self):
+        '''
+        Plain lists, for JSON
+        '''
+        data = {'files': list(self.files)}
+        for name, dtype in self.columns:
+            data[name] = getattr(self, name).tolist()
+        return data
+
+    @classmethod
+    def fromDict(cls, data):
+        res = cls(capacity=max(len(data['focus']), 1))
+        for name, dtype in cls.columns:
+            res.arrays[name][:len(data[name])] = data[name]
+        res.n = len(data['focus'])
+        res.files = list(data['files'])
+        return res
+
+    @classmethod
+    def load(cls, fname):
+        with np.load(fname) as f:
+            res = cls(capacity=max(len(f['focus']), 1))
+            for name, dtype in cls.columns:
+                res.arrays[name][:len(f[name])] = f[name]
+            res.n = len(f['focus'])
+            res.files = [str(x) for x in f['files']]
+        return res
@@ -0,0 +1,234 @@
+"""
+Analysis server: runs the SpecFocus measurements on a compute host, so that the GUI
+does not have to run them on the instrument GUI server.
+
+The server keeps a pool of worker processes and a cache of the widths already
+measured (keyed on file name, size, modification time, method and line index), so
+several clients, or the red and blue sides, share the same warm workers.
+As in SpecFocus.measureWidths, the arc lines are found on the first file of a
+request and the same line index is used to measure all the others.
+
+POST /analyze with a JSON body {"files": [...], "method": "moment"} returns one JSON
+object per line, as soon as each is available:
+    {"file": ..., "cached": ..., "results": FocusResults.toDict()}   for every file
+    {"fit": {"minX": ..., "error": ..., "nfiles": ...}}               after every file, once 3 focus values are measured
+    {"done": true}                                                    at the end
+    {"error": ...}                                                    if a file fails
+The file names must be visible from the server host.
+
+Usage: python FocusServer.py [--host localhost] [--port 8765] [--workers N]
+"""
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from FocusResults import FocusResults
+
+defaultPort = 8765
+
+
+def measureFile(fname, method, lineIndex=None):
+    """
+    Worker: measures the widths of one image with the line index of the first image
+    of the request, or its own if lineIndex is None.
+    Returns the FocusResults and the line index used (None if the image has no focus keyword)
+    """
+    import SpecFocus
+    with contextlib.redirect_stdout(io.StringIO()):
+        frame = SpecFocus.readFrame(fname)
+        if frame is None:
+            return FocusResults(), lineIndex
+        return SpecFocus.measureFrame(frame, lineIndex, method)
+
+
+def indexHash(lineIndex):
+    """
+    Short hash of a line index, for the cache key; None for an image measured with its own lines
+    """
+    if lineIndex is None:
+        return None
+    h = hashlib.sha1()
+    for col in sorted(lineIndex):
+        h.update(str(col).encode())
+        h.update(np.asarray(lineIndex[col], dtype=np.int64).tobytes())
+    return h.hexdigest()
+
+
+class AnalysisServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, workers=None, cacheSize=200):
+        super(AnalysisServer, self).__init__(address, AnalysisHandler)
+        # the server is multithreaded: the workers are not forked from it
+        self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                           mp_context=multiprocessing.get_context('forkserver'))
+        self.cache = collections.OrderedDict()
+        self.cacheSize = cacheSize
+        self.lock = threading.Lock()
+
+    def cacheKey(self, fname, method, lineIndex):
+        st = os.stat(fname)
+        return (os.path.abspath(fname), st.st_size, st.st_mtime, method, indexHash(lineIndex))
+
+    def getCached(self, key):
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        return None
+
+    def putCached(self, key, results):
+        with self.lock:
+            self.cache[key] = results
+            while len(self.cache) > self.cacheSize:
+                self.cache.popitem(last=False)
+
+
+class AnalysisHandler(BaseHTTPRequestHandler):
+
+    def send(self, obj):
+        self.wfile.write((json.dumps(obj) + '\n').encode())
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path != '/status':
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.send({'cached': len(self.server.cache)})
+
+    def do_POST(self):
+        if self.path != '/analyze':
+            self.send_error(404)
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            files = list(request['files'])
+            method = request.get('method', 'moment')
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_error(400, str(e))
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+
+        server = self.server
+        results = FocusResults()
+        files = collections.deque(files)
+        # the first image with a focus keyword gives the line index of the request
+        lineIndex = None
+        while files and lineIndex is None:
+            fname = files.popleft()
+            try:
+                key = server.cacheKey(fname, method, None)
+                cached = server.getCached(key)
+                if cached is None:
+                    res, lineIndex = server.pool.submit(measureFile, fname, method).result()
+                    server.putCached(key, (res, lineIndex))
+                else:
+                    res, lineIndex = cached
+            except Exception as e:
+                self.send({'error': '%s: %s' % (fname, e)})
+                continue
+            self.sendFile(results, fname, res, cached is not None)
+        futures = {}
+        for fname in files:
+            try:
+                key = server.cacheKey(fname, method, lineIndex)
+            except OSError as e:
+                self.send({'error': '%s: %s' % (fname, e)})
+                continue
+            cached = server.getCached(key)
+            if cached is not None:
+                self.sendFile(results, fname, cached[0], True)
+            else:
+                futures[server.pool.submit(measureFile, fname, method, lineIndex)] = (fname, key)
+        for fut in concurrent.futures.as_completed(futures):
+            fname, key = futures[fut]
+            try:
+                res = fut.result()
+            except Exception as e:
+                self.send({'error': '%s: %s' % (fname, e)})
+                continue
+            server.putCached(key, res)
+            self.sendFile(results, fname, res[0], False)
+        self.send({'done': True})
+
+    def sendFile(self, results, fname, res, cached):
+        """
+        Sends the widths of one file, then the fit of all the widths received so far
+        """
+        import SpecFocus
+        self.send({'file': fname, 'cached': cached, 'results': res.toDict()})
+        results.extend(res)
+        if len(results.focusValues()) >= 3:
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    pairs = results.pairs()
+                    funcV, m0, b0, minX = SpecFocus.fitPairs(pairs)
+                    error = SpecFocus.minXError(pairs)
+                self.send({'fit': {'minX': minX, 'error': error, 'nfiles': len(results.files)}})
+            except (ValueError, ZeroDivisionError):
+                pass
+
+
+def remoteMeasureWidths(url, files, method='moment', output=None, timeout=600):
+    """
+    Client side: same widths as SpecFocus.measureWidths(files, method), computed by the server at url
+    with the line index of the first file, in the order the files are finished.
+    output, if given, is called with a line of text for every file and fit update.
+    """
+    import urllib.request
+    body = json.dumps({'files': list(files), 'method': method}).encode()
+    request = urllib.request.Request(url.rstrip('/') + '/analyze', data=body,
+                                     headers={'Content-Type': 'application/json'})
+    results = FocusResults()
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        for line in response:
+            msg = json.loads(line)
+            if 'file' in msg:
+                res = FocusResults.fromDict(msg['results'])
+                results.extend(res)
+                text = "%s: %d widths%s\n" % (msg['file'], len(res), " (cached)" if msg['cached'] else "")
+            elif 'fit' in msg:
+                fit = msg['fit']
+                text = "Focus so far %f +/- %f (%d files)\n" % (fit['minX'], fit['error'], fit['nfiles'])
+            elif 'error' in msg:
+                text = "Error: %s\n" % msg['error']
+            else:
+                continue
+            if output:
+                output(text)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LRIS focus analysis server")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=defaultPort)
+    parser.add_argument('--workers', type=int, default=None, help="number of worker processes (default: all cores)")
+    args = parser.parse_args()
+    server = AnalysisServer((args.host, args.port), args.workers)
+    print("Serving focus analysis on http://%s:%d" % (args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.pool.shutdown()
+
+
+if __name__ == "__main__":
+    main()
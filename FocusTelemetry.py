@@ -0,0 +1,79 @@
+import json
+import time
+
+# phases of one step of a focus loop, in order; each one is timed from the end of the previous one
+phases = [('focus', 'move'),        # focus keyword written and motor in position
+          ('expose', 'start'),      # previous exposure finished and exposure started
+          ('shutter', 'expose'),    # shutter closed (wcrate)
+          ('readout', 'readout'),   # readout finished (observip/rserv)
+          ('file', 'write'),        # image found on disk
+          ('measured', 'measure')]  # widths measured (adaptive loop)
+
+# every step of every loop is appended to this file, one JSON object per line
+telemetryFile = 'LRIS_Focus_Telemetry.jsonl'
+
+
+class LoopTelemetry:
+    '''
+    Timestamps the phases of each step of a focus loop.
+    startStep opens a step, mark records the end of a phase, endStep
+    closes the step, appends it to fname and returns a one line breakdown.
+    '''
+    def __init__(self, side, fname=telemetryFile):
+        self.side = side
+        self.fname = fname
+        self.loopStart = time.time()
+        self.steps = []
+        self.step = None
+
+    def startStep(self, number, focus):
+        self.step = {'side': self.side, 'loop': self.loopStart, 'step': number, 'focus': focus,
+                     'start': time.time(), 'marks': {}}
+
+    def mark(self, phase):
+        if self.step is not None:
+            self.step['marks'][phase] = time.time()
+
+    def durations(self, step):
+        '''
+        Seconds spent in each phase of a step, by phase label; phases that were not marked are left out
+        '''
+        out = {}
+        last = step['start']
+        for phase, label in phases:
+            t = step['marks'].get(phase)
+            if t is not None:
+                out[label] = t - last
+                last = t
+        return out
+
+    def endStep(self):
+        step = self.step
+        if step is None:
+            return ''
+        self.step = None
+        step['end'] = time.time()
+        step['durations'] = self.durations(step)
+        self.steps.append(step)
+        try:
+            with open(self.fname, 'a') as f:
+                f.write(json.dumps(step) + '\n')
+        except OSError as e:
+            print("Cannot write the telemetry to %s: %s" % (self.fname, e))
+        total = step['end'] - step['start']
+        return "[%s] Step %d took %.1f s: %s\n" % (self.side.upper(), step['step'], total,
+                                                   ', '.join('%s %.1f s' % x for x in step['durations'].items()))
+
+    def summary(self):
+        '''
+        Time spent in each phase over the whole loop, with the fraction of the total
+        '''
+        if not self.steps:
+            return ''
+        totals = {}
+        for step in self.steps:
+            for label, t in step['durations'].items():
+                totals[label] = totals.get(label, 0.0) + t
+        total = sum(step['end'] - step['start'] for step in self.steps)
+        parts = ['%s %.1f s (%.0f%%)' % (label, t, 100 * t / total if total else 0) for label, t in totals.items()]
+        return "[%s] %d steps in %.1f s: %s\n" % (self.side.upper(), len(self.steps), total, ', '.join(parts))
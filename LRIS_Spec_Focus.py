@@ -13,16 +13,22 @@ except:
     print("KTL functions are not available")
     useKTL = False
 
-import matplotlib.pyplot as plt
+# startup timing: the reference point for the timings reported in the log
+startupTime = time.time()
+
 import numpy as np
-from PyQt5.QtCore import *
-from PyQt5.QtGui import *
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, QTimer, Qt, pyqtSignal, pyqtSlot
+from PyQt5.QtGui import QSyntaxHighlighter, QTextCharFormat, QImage, QPixmap, QPainter, QPen, QColor
 from PyQt5.QtWidgets import QLabel, QHBoxLayout, QLineEdit, QPushButton, QVBoxLayout, QApplication, QWidget, QTextEdit, \
-    QGridLayout, QCheckBox
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+    QGridLayout, QCheckBox, QListWidget, QListWidgetItem, QFileDialog
 
 # this imports the module written by S. Kwok.
+# SpecFocus loads matplotlib, scipy and astropy lazily, so importing it here is cheap.
 import SpecFocus
+import FocusDatabase
+import FocusCurves
+import FocusTelemetry
+import AnalysisProfiles
 
 
 class Log():
@@ -58,11 +64,11 @@ class Log():
 
 
 # setup logging
+# the log file itself is created in main(), once the window is on the screen
 Day = time.strftime("%m-%d-%Y", time.localtime())
 Time = time.strftime("%I:%M:%S-%p", time.localtime())
 log_file_name = 'LRIS_Spec_Focus_%s_%s.log' % (Day, Time)
 log = Log()
-log.setFile(log_file_name)
 
 # set this variable to LOCAL if you are using test images on the current directory
 # Any other value will use outdir and the keywords
@@ -71,14 +77,28 @@ run_mode = None #'LOCAL'
 # of the current directory
 # data_directory = '/Users/lrizzi/LRIS_FOCUS_DATA'
 
+# set this variable to the URL of an analysis server (see FocusServer.py) to run the measurements
+# there instead of in the GUI; the server must see the data directory at the same path
+analysis_server = None #'http://localhost:8765'
 
+# set this variable to True to measure with the streaming pipeline (FocusPipeline.py) instead of
+# measureWidths; FocusRegression.py shows whether it is faster on this machine
+use_pipeline = False
 
-def main():
 
 
+def main():
+
+    importsDone = time.time()
     app = QApplication(sys.argv)
     w = MyWindow()
     w.show()
+    shown = time.time()
+    log.setFile(log_file_name)
+    log.info("Startup: imports %.2f s, window shown after %.2f s" % (importsDone - startupTime, shown - startupTime))
+    # load the heavy scientific modules in the background, while the operator looks at the control panel
+    w.run_preload()
+    w.predictFocus()
     sys.exit(app.exec_())
 
 
@@ -162,7 +182,88 @@ class Highlighter(QSyntaxHighlighter):
             self.setFormat(0, len(text), self.redFormat)
 
 
+class PreviewLabel(QLabel):
+    '''
+    Quick-look of the last analyzed frame, drawn from the downsampled pyramid built during the read.
+    The sampled columns and the line windows used by findWidths are overlaid.
+    Clicking on the image shows the full resolution tile around that point, read from disk
+    on demand; clicking again goes back to the whole frame.
+    '''
+    displaySize = 400
+    tileSize = 256
+
+    def __init__(self):
+        super(PreviewLabel, self).__init__("The last frame will appear here")
+        self.setAlignment(Qt.AlignLeft | Qt.AlignTop)
+        self.setMinimumSize(self.displaySize, self.displaySize)
+        self.info = None
+        self.zoomed = False
+
+    def toPixmap(self, img):
+        """
+        Scales an image to 8 bits between the 1 and 99.5 percentiles and returns a QPixmap
+        """
+        lo, hi = np.percentile(img, (1, 99.5))
+        img8 = np.clip((img - lo) * 255.0 / max(hi - lo, 1), 0, 255).astype(np.uint8)
+        img8 = np.ascontiguousarray(img8)
+        qimg = QImage(img8.data, img8.shape[1], img8.shape[0], img8.shape[1], QImage.Format_Grayscale8)
+        return QPixmap.fromImage(qimg.copy()).scaled(self.displaySize, self.displaySize, Qt.KeepAspectRatio)
+
+    def drawOverlay(self, pixmap, x0, y0, scale):
+        """
+        Draws the sampled columns and line windows; mosaic pixel (x, y) is drawn at ((x-x0)*scale, (y-y0)*scale)
+        """
+        painter = QPainter(pixmap)
+        painter.setPen(QPen(QColor('yellow'), 1))
+        half = self.info['size'] / 2
+        for col, lines in zip(self.info['columns'], self.info['lines']):
+            x = (col - x0) * scale
+            if x < 0 or x > pixmap.width():
+                continue
+            painter.drawLine(int(x), 0, int(x), pixmap.height())
+            for line in lines:
+                painter.drawRect(int(x) - 3, int((line - half - y0) * scale), 6, max(int(2 * half * scale), 1))
+        painter.end()
+        return pixmap
+
+    def setPreview(self, info):
+        self.info = info
+        self.zoomed = False
+        # the smallest level that still covers the display
+        levels = info['pyramid']
+        factor, img = levels[0]
+        for f, level in levels:
+            if max(level.shape) >= self.displaySize:
+                factor, img = f, level
+        pixmap = self.toPixmap(img)
+        self.scale = pixmap.width() / (img.shape[1] * factor)
+        self.setPixmap(self.drawOverlay(pixmap, 0, 0, self.scale))
+
+    def mousePressEvent(self, event):
+        if self.info is None:
+            return
+        if self.zoomed:
+            self.setPreview(self.info)
+            return
+        import MosaicFitsReader
+        x = int(event.pos().x() / self.scale)
+        y = int(event.pos().y() / self.scale)
+        reader = MosaicFitsReader.MosaicFitsReader(self.info['file'], readData=False)
+        rows, cols = reader.shape
+        x0 = min(max(x - self.tileSize // 2, 0), cols - self.tileSize)
+        y0 = min(max(y - self.tileSize // 2, 0), rows - self.tileSize)
+        tile = reader.readCuts(range(x0, x0 + self.tileSize), (y0, y0 + self.tileSize))
+        pixmap = self.toPixmap(tile)
+        self.setPixmap(self.drawOverlay(pixmap, x0, y0, pixmap.width() / self.tileSize))
+        self.zoomed = True
+
+
 class MyWindow(QWidget):
+    # focus corrections applied before moving to a lower focus value
+    backlash_correction = {'red': -1.0, 'blue': -200}
+    # lowest allowed blue focus value
+    blueFocusLimit = -3820
+
     def __init__(self, *args):
         super().__init__()
         # runMode can be set to debug if we don't want to run the command, but just see that the buttons are connected correctly
@@ -174,6 +275,15 @@ class MyWindow(QWidget):
         # call to the main routine to create the interface
         self.threadpool = QThreadPool()
         print("Multithreading with maximum %d threads" % self.threadpool.maxThreadCount())
+        # history of the focus fits, used to predict the starting values of the loops
+        self.focusdb = FocusDatabase.FocusDatabase()
+        # images taken by the last adaptive loop of each side
+        self.loopFiles = {}
+        # analyzed sequences that can be overlaid on the plot
+        self.curves = FocusCurves.FocusCurves()
+        self.currentCurve = None
+        self.currentSide = None
+        self.pairs = None
         self.init_ui()
 
     def init_ui(self):
@@ -239,6 +349,12 @@ class MyWindow(QWidget):
 
         self.red_side_current_settings = QCheckBox("Preserve current RED side CCD settings?")
         self.red_side_current_settings.setCheckState(Qt.Unchecked)
+        self.adaptive_loop = QCheckBox("Adaptive focus loop (stop when the focus is found, at most Number images)?")
+        self.adaptive_loop.setCheckState(Qt.Unchecked)
+        self.fast_mode = QCheckBox("Fast focus mode (binned readout of a window of the detector)?")
+        self.fast_mode.setCheckState(Qt.Unchecked)
+        self.gaussian_fit = QCheckBox("Measure widths with Gaussian line fits?")
+        self.gaussian_fit.setCheckState(Qt.Unchecked)
         self.expose_red = QPushButton("Take red focus images")
         self.expose_red.setStyleSheet("background-color: %s" % self.redColor)
         self.expose_red.clicked.connect(self.takeRedImages)
@@ -291,6 +407,9 @@ class MyWindow(QWidget):
         self.vlayout1.addWidget(self.tdaConfig)
         self.vlayout1.addWidget(self.lampsOn)
         self.vlayout1.addWidget(self.red_side_current_settings)
+        self.vlayout1.addWidget(self.gaussian_fit)
+        self.vlayout1.addWidget(self.adaptive_loop)
+        self.vlayout1.addWidget(self.fast_mode)
         self.vlayout1.addLayout(self.grid1)
         self.vlayout1.addWidget(self.lampsOff)
         self.setBluFocus.setEnabled(False)
@@ -299,14 +418,64 @@ class MyWindow(QWidget):
         self.vlayout1.addWidget(self.qbtn)
         self.vlayout1.addWidget(self.output)
 
-        self.figure = plt.figure(figsize=(4, 4))
-        self.canvas = FigureCanvas(self.figure)
+        # the matplotlib figure is expensive to build on the remote X display:
+        # show a placeholder now and build the canvas the first time it is needed
+        self.figure = None
+        self.canvas = QLabel("The focus plot will appear here")
+        self.canvas.setAlignment(Qt.AlignCenter)
+        self.canvas.setMinimumSize(400, 400)
+        # sequences kept for comparison: checked ones are overlaid on the plot
+        self.sequences = QListWidget()
+        self.sequences.setMaximumHeight(150)
+        self.sequences.itemChanged.connect(self.toggleSequence)
+        self.loadSequence = QPushButton("Load saved sequences")
+        self.loadSequence.setStyleSheet("background-color: %s" % self.genericColor)
+        self.loadSequence.clicked.connect(self.loadSequences)
+        self.plotLayout = QVBoxLayout()
+        self.plotLayout.addWidget(self.canvas)
+        self.plotLayout.addWidget(QLabel("Sequences to compare"))
+        self.plotLayout.addWidget(self.sequences)
+        self.plotLayout.addWidget(self.loadSequence)
         self.layout = QHBoxLayout()
         self.layout.addLayout(self.vlayout1)
-        self.layout.addWidget(self.canvas)
+        self.layout.addLayout(self.plotLayout)
+        self.preview = PreviewLabel()
+        self.layout.addWidget(self.preview)
 
         self.setLayout(self.layout)
 
+    def createCanvas(self):
+        """
+        Builds the matplotlib figure and canvas, replacing the placeholder
+        """
+        if self.figure is not None:
+            return
+        t0 = time.time()
+        import matplotlib.pyplot as plt
+        from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+        self.figure = plt.figure(figsize=(4, 4))
+        canvas = FigureCanvas(self.figure)
+        self.layout.replaceWidget(self.canvas, canvas)
+        self.canvas.deleteLater()
+        self.canvas = canvas
+        log.info("Plot canvas created in %.2f s" % (time.time() - t0))
+
+    def run_preload(self):
+        """
+        Imports the analysis modules in a background thread, then builds the plot canvas
+        """
+        worker = Worker(self.preload)
+        worker.signals.finished.connect(lambda: QTimer.singleShot(0, self.createCanvas))
+        self.threadpool.start(worker)
+
+    def preload(self, output_callback):
+        t0 = time.time()
+        SpecFocus.preload()
+        if use_pipeline and not analysis_server:
+            import FocusPipeline
+            FocusPipeline.warmUp()
+        log.info("Analysis modules loaded in %.2f s (%.2f s after start)" % (time.time() - t0, time.time() - startupTime))
+
     def setFocus(self):
         sender =  self.sender().text()
         log.info("Sender is %s" % sender)
@@ -351,24 +520,42 @@ class MyWindow(QWidget):
 
     def plot(self):
         """
-        Plots the (focus, std) pairs
+        Plots the (focus, std) pairs of the current analysis with its fit, and
+        overlays the sequences checked in the comparison list.
+        Red and blue sequences are shown in separate panels, their focus scales differ.
         """
+        import matplotlib.pyplot as plt
+        self.createCanvas()
+        plt.figure(self.figure.number)
         plt.clf()
 
-        xpoints = set(self.pairs[0])
-        print(xpoints)
-        uniqueX = []
-        uniqueY = []
-        for point in xpoints:
-            print(point)
-            selectedPoints = self.pairs[1][(self.pairs[0] == point)]
-            averagePoint = np.median(selectedPoints)
-            uniqueY= np.append(uniqueY, averagePoint)
-            uniqueX= np.append(uniqueX, point)
-
-        #plt.plot(self.pairs[0], self.pairs[1], 'o')
-        print(uniqueX)
-        print(uniqueY)
+        overlays = [c for c in self.curves.visible() if c is not self.currentCurve]
+        hasCurrent = self.pairs is not None
+        sides = [side for side in ('red', 'blue')
+                 if (hasCurrent and side == self.currentSide) or any(c.side == side for c in overlays)]
+        for k, side in enumerate(sides):
+            plt.subplot(len(sides), 1, k + 1)
+            if hasCurrent and side == self.currentSide:
+                self.plotCurrent()
+            else:
+                plt.title("%s sequences" % side.capitalize())
+            others = [c for c in overlays if c.side == side]
+            for c in others:
+                line = plt.plot(c.modelX, c.modelY, '--')[0]
+                plt.plot(c.x, c.y, 's', mfc='none', color=line.get_color(), label="%s: %.2f" % (c.label, float(c.minX)))
+            if others:
+                plt.legend(fontsize='small')
+            plt.grid()
+
+        self.canvas.draw()
+
+    def plotCurrent(self):
+        """
+        Plots the median width at each focus value of the current analysis,
+        the fitted hyperbola, the best focus and the asymptotes
+        """
+        import matplotlib.pyplot as plt
+        uniqueX, uniqueY = SpecFocus.aggregatePairs(self.pairs)
         plt.plot(uniqueX, uniqueY, 'o')
         padding = 10  # this means 10% of the range will be added to each side of the plot
 
@@ -396,26 +583,104 @@ class MyWindow(QWidget):
 
         plt.plot((x0, self.minX), (negAsymp(x0), negAsymp(self.minX)), 'g-')
         plt.plot((self.minX, x1), (posAsymp(self.minX), posAsymp(x1)), 'g-')
-        plt.grid()
         plt.title("Focus: %.2f" % (float(self.minX)))
 
-        self.canvas.draw()
-
-
-    def analyzeFocus(self):
+    def addCurve(self, curve):
         """
-        Reads the selected number of images and produces the data to be plotted
+        Keeps an analyzed sequence for comparison and lists it, checked
         """
-        # how many images do I look for:
-        sender = self.sender().text()
-        if sender == 'Measure red focus':
-            prefix = 'rfoc*.fits'
-            numberToAnalyze = int(self.number_red.text())
-        elif sender == 'Measure blue focus':
-            prefix = 'bfoc*.fits'
-            numberToAnalyze = int(self.number_blu.text())
+        dropped = self.curves.add(curve)
+        self.sequences.blockSignals(True)
+        for label in dropped + [curve.label]:
+            for item in self.sequences.findItems(label, Qt.MatchExactly):
+                self.sequences.takeItem(self.sequences.row(item))
+        item = QListWidgetItem(curve.label)
+        item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
+        item.setCheckState(Qt.Checked if curve.visible else Qt.Unchecked)
+        self.sequences.addItem(item)
+        self.sequences.blockSignals(False)
+
+    def toggleSequence(self, item):
+        """
+        Shows or hides a sequence of the comparison list
+        """
+        self.curves[item.text()].visible = item.checkState() == Qt.Checked
+        self.plot()
 
+    def loadSequences(self):
+        """
+        Adds sequences saved by earlier analyses (.npz files) to the comparison list
+        """
+        files, _ = QFileDialog.getOpenFileNames(self, "Load focus sequences", os.getcwd(), "Focus measurements (*.npz)")
+        for f in files:
+            try:
+                results = SpecFocus.FocusResults.load(f)
+                curve = FocusCurves.FocusCurve.fromResults(os.path.basename(f), results)
+            except (OSError, KeyError, ValueError, ZeroDivisionError, TypeError) as e:
+                self.showOutput("Cannot load %s: %s\n" % (f, e))
+                continue
+            self.addCurve(curve)
+        if files:
+            self.plot()
 
+    def predictFocus(self):
+        """
+        Pre-fills center and step of the focus loops from the focus history
+        for the current instrument configuration
+        """
+        defaults = {'red': (self.center_red, self.step_red, self.number_red, 0.05, "%.2f"),
+                    'blue': (self.center_blu, self.step_blu, self.number_blu, 90, "%d")}
+        info = None
+        if useKTL:
+            try:
+                info = {'grating': self.lris['graname'].read(),
+                        'grism': self.lris['grisname'].read(),
+                        'dichroic': self.lris['dichname'].read()}
+            except Exception as e:
+                # the prediction then uses the history of all the configurations
+                log.warning("Cannot read the instrument configuration: %s" % e)
+                info = None
+        for side, (center, step, number, defaultStep, fmt) in defaults.items():
+            prediction = self.focusdb.predict(side, info)
+            if prediction is None:
+                continue
+            focus, scatter, n = prediction
+            center.setText(fmt % focus)
+            if scatter:
+                # cover +/- 3 sigma of the recent fits, but never more than the default range
+                newStep = 6 * scatter / max(int(number.text()) - 1, 1)
+                newStep = min(max(newStep, defaultStep / 3), defaultStep)
+                step.setText(fmt % newStep)
+            self.showOutput("[%s] Predicted focus %s +/- %s from %d previous fits\n" % (side.upper(), fmt % focus, fmt % (scatter or 0), n))
+
+    def recordFocus(self, side):
+        """
+        Adds the last fit to the focus history, unless these files were already recorded
+        """
+        try:
+            error = SpecFocus.minXError(self.pairs)
+            self.showOutput(" +/- %.3f\n" % error)
+        except Exception:
+            error = None
+        info = FocusDatabase.headerInfo(self.files[-1])
+        if not self.focusdb.record(side, self.minX, error, info, nfiles=len(self.files), files=self.files):
+            log.info("These %s images are already in the focus history" % side)
+
+    def showFocusMap(self):
+        """
+        Displays the best focus measured in each detector tile, and the fitted tip/tilt
+        """
+        tileX, tileY, focusMap, plane = SpecFocus.fitFocusMap(self.out)
+        self.showOutput("\nFocus map (rows: y, columns: x)\n")
+        self.showOutput("      " + "".join("%10d" % x for x in tileX) + "\n")
+        for y, line in zip(tileY, focusMap):
+            self.showOutput("%6d" % y + "".join("%10.3f" % f for f in line) + "\n")
+        self.showOutput("Tilt: %.3g per 1000 px in x, %.3g per 1000 px in y\n" % (plane[1] * 1000, plane[2] * 1000))
+
+    def focusDirectory(self):
+        """
+        Returns the directory where the focus images are written
+        """
         #run_mode = 'LOCAL'
         #data_directory = '/Users/lrizzi/LRIS_FOCUS_DATA'
 
@@ -426,30 +691,128 @@ class MyWindow(QWidget):
                 directory = data_directory
             else:
                 directory = os.getcwd()
+        return directory
+
+    def focusFiles(self, prefix):
+        """
+        Returns the focus images matching prefix, oldest first
+        """
+        files = glob.glob(os.path.join(self.focusDirectory(), prefix))
+        files.sort(key=os.path.getmtime)
+        return files
 
+    def analyzeFocus(self):
+        """
+        Reads the selected number of images and produces the data to be plotted
+        """
+        # how many images do I look for:
+        sender = self.sender().text()
+        if sender == 'Measure red focus':
+            prefix = 'rfoc*.fits'
+            numberToAnalyze = int(self.number_red.text())
+        elif sender == 'Measure blue focus':
+            prefix = 'bfoc*.fits'
+            numberToAnalyze = int(self.number_blu.text())
 
 
-        self.files = glob.glob(os.path.join(directory, prefix))
-        self.files.sort(key=os.path.getmtime)
-        self.files = self.files[-numberToAnalyze:]
+        directory = self.focusDirectory()
+        side = 'red' if prefix.startswith('r') else 'blue'
+        if side in self.loopFiles:
+            # images of the last adaptive loop, analyzed once
+            self.files = self.loopFiles.pop(side)
+        else:
+            self.files = self.focusFiles(prefix)[-numberToAnalyze:]
         self.showOutput("Files to be analyzed: %s \n" % (str(self.files)))
         if len(self.files) > 0:
-            self.out = SpecFocus.measureWidths(self.files)
-            print(self.out)
-            self.pairs = SpecFocus.generatePairs(self.out)
-            self.funcV, self.m0, self.b0, self.minX = SpecFocus.fitPairs(self.pairs)
-            self.plot()
-            self.showOutput("\nThe Focus is %.2f" % (float(self.minX)))
-            if sender == 'Measure red focus':
-                self.bestRedFocus = self.minX
-                self.setRedFocus.setEnabled(True)
-            elif sender == 'Measure blue focus':
-                self.bestBluFocus = self.minX
-                self.setBluFocus.setEnabled(True)
+            if self.gaussian_fit.isChecked():
+                method = 'gaussian'
+            else:
+                method = 'moment'
+            self.showOutput("Width estimator: %s\n" % method)
+            # the frames are measured in the background; the plot is updated after each one
+            self.out = SpecFocus.FocusResults()
+            self.preview_info = {}
+            self.pairs = None
+            self.currentSide = side
+            self.currentCurve = None
+            button = self.analyze_red if side == 'red' else self.analyze_blu
+            worker = Worker(self.measureFocus, self.files, method, self.preview_info)
+            worker.signals.started.connect(lambda: button.setEnabled(False))
+            worker.signals.output.connect(self.frameMeasured)
+            worker.signals.result.connect(lambda results: self.focusMeasured(side, prefix, results))
+            worker.signals.error.connect(lambda error: self.showOutput("\nThe analysis failed: %s\n" % str(error[1])))
+            worker.signals.finished.connect(lambda: button.setEnabled(True))
+            self.threadpool.start(worker)
 
         else:
             print("No files to examine in directory [%s]" % (directory))
 
+    def measureFocus(self, files, method, preview, output_callback):
+        """
+        Runs in a worker thread: measures the files, either on the analysis server
+        with the streaming pipeline (use_pipeline) or with measureWidths. The widths of each
+        frame are emitted as they come.
+        """
+        if analysis_server:
+            import FocusServer
+            output_callback.emit("Sending the files to the analysis server %s\n" % analysis_server)
+            return FocusServer.remoteMeasureWidths(analysis_server, files, method, output=output_callback.emit)
+        if use_pipeline:
+            import FocusPipeline
+            return FocusPipeline.runPipeline(files, method, callback=output_callback.emit, preview=preview)
+        return SpecFocus.measureWidths(files, method, preview=preview, callback=output_callback.emit)
+
+    def frameMeasured(self, msg):
+        """
+        Receives the widths of one frame (or a text message) and updates the plot
+        """
+        if isinstance(msg, str):
+            self.showOutput(msg)
+            return
+        self.out.extend(msg)
+        self.showOutput("%s: %d widths\n" % (os.path.basename(msg.files[0]) if msg.files else '', len(msg)))
+        if len(self.out.focusValues()) >= 3:
+            try:
+                self.pairs = SpecFocus.generatePairs(self.out)
+                self.funcV, self.m0, self.b0, self.minX = SpecFocus.fitPairs(self.pairs)
+                self.plot()
+            except (ValueError, ZeroDivisionError):
+                # not enough frames yet for a meaningful fit
+                pass
+
+    def focusMeasured(self, side, prefix, results):
+        """
+        Final fit, once all the frames have been measured
+        """
+        self.out = results
+        if self.preview_info:
+            self.preview.setPreview(self.preview_info)
+        print(self.out)
+        if len(self.out) == 0:
+            self.showOutput("\nNo line widths could be measured\n")
+            return
+        # keep the measurements, so the session can be reloaded and compared later
+        results_file = 'LRIS_Spec_Focus_%s_%s.npz' % (prefix[0:4], time.strftime("%m-%d-%Y_%I:%M:%S-%p", time.localtime()))
+        self.out.save(results_file)
+        log.info("Measurements saved to %s" % results_file)
+        self.pairs = SpecFocus.generatePairs(self.out)
+        fit = SpecFocus.fitPairs(self.pairs)
+        self.funcV, self.m0, self.b0, self.minX = fit
+        label = "%s %s %s" % (side, time.strftime("%m-%d %H:%M"), os.path.basename(self.out.files[0]))
+        self.currentCurve = FocusCurves.FocusCurve(label, side, self.pairs, fit)
+        self.addCurve(self.currentCurve)
+        self.plot()
+        self.showOutput("\nThe Focus is %.2f" % (float(self.minX)))
+        if side == 'red':
+            self.bestRedFocus = self.minX
+            self.setRedFocus.setEnabled(True)
+            self.recordFocus('red')
+        elif side == 'blue':
+            self.bestBluFocus = self.minX
+            self.setBluFocus.setEnabled(True)
+            self.recordFocus('blue')
+        self.showFocusMap()
+
     def run_turnOnLamps(self):
         """
         Turn on the calibration lamps
@@ -558,7 +921,7 @@ class MyWindow(QWidget):
         log.info("Running saveRedState")
         if useKTL:
             self.originalPrefixRed = self.lris['outfile'].read()
-            self.binningx_red,self.binningy_red = self.lris['binning'].read(binary=True)
+            self.savedRedState = self.saveDetectorState(self.lris, 'red')
 
 
     def saveBluState(self):
@@ -568,11 +931,44 @@ class MyWindow(QWidget):
         log.info("Running saveBlueState")
         if useKTL:
             self.originalPrefixBlu = self.lrisblue['outfile'].read()
-            self.binningx_blu,self.binningy_blu = self.lris['binning'].read(binary=True)
+            self.savedBluState = self.saveDetectorState(self.lrisblue, 'blue')
+
+    def saveDetectorState(self, service, side):
+        """
+        Reads the current values of all the keywords that the standard or fast
+        focus setups of a side write, so that they can be restored afterwards
+        """
+        state = {}
+        keywords = set(AnalysisProfiles.acquisitionSetup[side]) | set(AnalysisProfiles.fastSetup[side])
+        for keyword in sorted(keywords):
+            try:
+                state[keyword] = service[keyword].read(binary=True)
+            except Exception as e:
+                log.warning("Cannot read %s: %s" % (keyword, e))
+        return state
+
+    def restoreDetectorState(self, service, state):
+        """
+        Writes back the values saved by saveDetectorState, in the binary form
+        they were read in. Every keyword is tried, even if some of them fail.
+        """
+        for keyword, value in state.items():
+            try:
+                service[keyword].write(value, binary=True)
+            except Exception as e:
+                self.showOutput("Cannot restore %s to %s: %s\n" % (keyword, str(value), e))
+
+    def focusSetup(self, side):
+        """
+        Detector setup of the focus images: the fast windowed and binned readout if selected
+        """
+        if self.fast_mode.isChecked():
+            return AnalysisProfiles.fastSetup[side]
+        return AnalysisProfiles.acquisitionSetup[side]
 
     def redSideDone(self):
         """
-        Run when the red side images have been taken, to restore binning, ccdspeed, and original file names
+        Run when the red side images have been taken, to restore the detector setup, ccdspeed, and original file names
         """
         log.info("Running redSideDone")
         self.expose_red.setEnabled(True)
@@ -580,25 +976,18 @@ class MyWindow(QWidget):
         if useKTL:
             self.lris['outfile'].write(self.originalPrefixRed)
             self.lris['ccdspeed'].write('normal')
-            self.lris['binning'].write([self.binningx_red,self.binningy_red])
+            self.restoreDetectorState(self.lris, self.savedRedState)
 
     def bluSideDone(self):
         """
-        Run when the blue side images have been taken, to restore binning, ccdspeed, and original file names
+        Run when the blue side images have been taken, to restore the detector setup and original file names
         """
         log.info("Running blueSideDone")
         self.expose_blu.setEnabled(True)
         self.showOutput("Blue side focus images complete\n")
         if useKTL:
             self.lrisblue['outfile'].write(self.originalPrefixBlu)
-            self.lrisblue['numamps'].write(4)
-            self.lrisblue['amplist'].write([1,4,0,0])
-            self.lrisblue['ccdsel'].write('mosaic')
-            self.lrisblue['binning'].write([1,1])
-            self.lrisblue['window'].write([1,0,0,2048,4096])
-            self.lrisblue['prepix'].write(51)
-            self.lrisblue['postpix'].write(80)
-            #self.lrisblue['binning'].write([self.binningx_blu,self.binningy_blu])
+            self.restoreDetectorState(self.lrisblue, self.savedBluState)
 
     def takeRedImages(self):
         """
@@ -607,22 +996,30 @@ class MyWindow(QWidget):
         log.info("Button Takeredimages pressed")
         self.saveRedState()
         if useKTL:
-            self.lris['outfile'].write('rfoc_')
-            if self.red_side_current_settings.isChecked():
-                self.showOutput("Preserving settings for the red side")
-            else:
-                self.lris['binning'].write([1,1])
-                self.lris['pane'].write([0,0,4096,4096])
-            self.lris['ttime'].write(1)
-            self.lris['ccdspeed'].write('fast')
-            self.lris['object'].write('Focus loop')
+            try:
+                self.lris['outfile'].write('rfoc_')
+                if self.red_side_current_settings.isChecked():
+                    self.showOutput("Preserving settings for the red side")
+                else:
+                    for keyword, value in self.focusSetup('red').items():
+                        self.lris[keyword].write(value)
+                self.lris['ttime'].write(1)
+                self.lris['ccdspeed'].write('fast')
+                self.lris['object'].write('Focus loop')
+            except Exception as e:
+                self.showOutput("Cannot set up the red side for the focus loop: %s\n" % e)
+                self.redSideDone()
+                return
 
         center = float(self.center_red.text())
         step = float(self.step_red.text())
         number = int(self.number_red.text())
         startingPoint = float(center - (step * (number / 2)))
 
-        worker = Worker(self.focusloop, 'red', startingPoint, number, step)
+        if self.adaptive_loop.isChecked():
+            worker = Worker(self.adaptiveFocusloop, 'red', center, number, step)
+        else:
+            worker = Worker(self.focusloop, 'red', startingPoint, number, step)
         worker.signals.started.connect(lambda: self.expose_red.setEnabled(False))
         worker.signals.result.connect(self.showOutput)
         worker.signals.output.connect(self.showOutput)
@@ -637,23 +1034,26 @@ class MyWindow(QWidget):
         log.info("Button Takeblueimages pressed")
         self.saveBluState()
         if useKTL:
-            self.lrisblue['outfile'].write('bfoc_')
-            self.lrisblue['numamps'].write(4)
-            self.lrisblue['amplist'].write([1,4,0,0])
-            self.lrisblue['ccdsel'].write('mosaic')
-            self.lrisblue['binning'].write([1,1])
-            self.lrisblue['window'].write([1,0,0,2048,4096])
-            self.lrisblue['prepix'].write(51)
-            self.lrisblue['postpix'].write(80)
-            self.lrisblue['ttime'].write(1)
-            self.lris['object'].write('Focus loop')
+            try:
+                self.lrisblue['outfile'].write('bfoc_')
+                for keyword, value in self.focusSetup('blue').items():
+                    self.lrisblue[keyword].write(value)
+                self.lrisblue['ttime'].write(1)
+                self.lris['object'].write('Focus loop')
+            except Exception as e:
+                self.showOutput("Cannot set up the blue side for the focus loop: %s\n" % e)
+                self.bluSideDone()
+                return
 
         center = float(self.center_blu.text())
         step = int(self.step_blu.text())
         number = int(self.number_blu.text())
         startingPoint = float(center - (step * (number / 2)))
 
-        worker = Worker(self.focusloop,'blue',startingPoint, number, step)
+        if self.adaptive_loop.isChecked():
+            worker = Worker(self.adaptiveFocusloop, 'blue', center, number, step)
+        else:
+            worker = Worker(self.focusloop,'blue',startingPoint, number, step)
         worker.signals.started.connect(lambda: self.expose_blu.setEnabled(False))
         worker.signals.result.connect(self.showOutput)
         worker.signals.output.connect(self.showOutput)
@@ -672,9 +1072,9 @@ class MyWindow(QWidget):
             keyword = lris['redfocus']
         elif side == 'blue':
             keyword = lris['blufocus']
-            if value<-3820:
-                output_callback.emit("Blue focus value is beyond limits. Resetting to -3820\n")
-                value = -3820
+            if value<self.blueFocusLimit:
+                output_callback.emit("Blue focus value is beyond limits. Resetting to %d\n" % self.blueFocusLimit)
+                value = self.blueFocusLimit
         else:
             return
         keyword.write(value)
@@ -682,9 +1082,8 @@ class MyWindow(QWidget):
 
     def focusloop(self, side, startingPoint, number_of_steps, increment, output_callback):
 
-        backlash_correction = {}
-        backlash_correction['red'] = -1.0
-        backlash_correction['blue'] = -200
+        backlash_correction = self.backlash_correction
+        self.loopFiles.pop(side, None)
 
         if side not in ['red', 'blue']:
             output_callback.emit(self, 'Error in side specification')
@@ -694,6 +1093,11 @@ class MyWindow(QWidget):
             output_callback.emit(self, 'Too many steps requested')
             return
 
+        prefix = 'rfoc*.fits' if side == 'red' else 'bfoc*.fits'
+        telemetry = FocusTelemetry.LoopTelemetry(side)
+        # the anti-backlash move is timed as part of the first step
+        telemetry.startStep(1, startingPoint)
+
         # backlash correction
         log.info("Applying anti-backlash correction to %s side" % side)
         self.setLrisFocus(side, startingPoint + backlash_correction[side], output_callback)
@@ -701,18 +1105,117 @@ class MyWindow(QWidget):
         log.info("Starting focus sequence on %s side" % side)
         for step in range(number_of_steps):
             focus = startingPoint + step * increment
+            if step > 0:
+                telemetry.startStep(step+1, focus)
+            # without KTL there is no output directory to watch (dry run)
+            before = set(self.focusFiles(prefix)) if useKTL else set()
             self.setLrisFocus(side, focus, output_callback)
+            telemetry.mark('focus')
             #print("Acquiring %s image at focus value %f\n" % (side,focus))
 
             #self.showOutput("Acquiring %s image at focus value %f\n" % (side,focus))
             output_callback.emit("[%s] Image %d of %d: %s image at focus value %f\n" % (side.upper(), step+1, number_of_steps,side,focus))
             if side == 'red':
-                self.goir()
+                self.goir(telemetry)
             elif side == 'blue':
-                self.goib()
+                self.goib(telemetry)
+            if self.waitForImage(prefix, before):
+                telemetry.mark('file')
+            output_callback.emit(telemetry.endStep())
+        output_callback.emit(telemetry.summary())
+
 
+    def moveFocus(self, side, value, current, output_callback):
+        """
+        Moves the focus to value. Moves towards lower values overshoot by the
+        backlash correction, so that the final approach is always upwards.
+        Returns the new focus value.
+        """
+        if current is None or value < current:
+            self.setLrisFocus(side, value + self.backlash_correction[side], output_callback)
+        self.setLrisFocus(side, value, output_callback)
+        return value
 
-    def goib(self):
+    def adaptiveFocusloop(self, side, center, max_steps, increment, output_callback):
+        """
+        Focus loop that measures each image as soon as it is written, and chooses the next
+        focus value from the measurements (SpecFocus.nextFocusPosition).
+        Stops when the error on the best focus is below a tenth of the step, or after max_steps images.
+        """
+        if side not in ['red', 'blue']:
+            output_callback.emit('Error in side specification')
+            return
+        prefix = 'rfoc*.fits' if side == 'red' else 'bfoc*.fits'
+        tolerance = abs(increment) / 10
+        results = SpecFocus.FocusResults()
+        lineIndex = None
+        files = []
+        current = None
+        done = False
+        limits = (self.blueFocusLimit, None) if side == 'blue' else (None, None)
+        telemetry = FocusTelemetry.LoopTelemetry(side)
+        log.info("Starting adaptive focus sequence on %s side" % side)
+        for step in range(max_steps):
+            done, focus, minX, error = SpecFocus.nextFocusPosition(results, center, increment, tolerance, limits=limits)
+            if minX is not None:
+                output_callback.emit("[%s] Current best focus %f +/- %f\n" % (side.upper(), minX, error))
+            if done or focus is None:
+                # accurate enough, or no position left to measure
+                break
+            telemetry.startStep(step+1, focus)
+            current = self.moveFocus(side, focus, current, output_callback)
+            telemetry.mark('focus')
+            output_callback.emit("[%s] Image %d (max %d): %s image at focus value %f\n" % (side.upper(), step+1, max_steps, side, focus))
+            # without KTL there is no output directory to watch (dry run)
+            before = set(self.focusFiles(prefix)) if useKTL else set()
+            if side == 'red':
+                self.goir(telemetry)
+            elif side == 'blue':
+                self.goib(telemetry)
+            new = self.waitForImage(prefix, before)
+            if not new:
+                output_callback.emit(telemetry.endStep())
+                output_callback.emit("[%s] No new image found, stopping the adaptive loop\n" % side.upper())
+                break
+            telemetry.mark('file')
+            files += new
+            # the line index of the first image is used for all the others, as in measureWidths
+            for f in new:
+                frame = SpecFocus.readFrame(f)
+                if frame is not None:
+                    frameResults, lineIndex = SpecFocus.measureFrame(frame, lineIndex)
+                    results.extend(frameResults)
+            telemetry.mark('measured')
+            output_callback.emit(telemetry.endStep())
+        output_callback.emit(telemetry.summary())
+        if not done and len(results) > 0:
+            done, focus, minX, error = SpecFocus.nextFocusPosition(results, center, increment, tolerance, limits=limits)
+        self.loopFiles[side] = files
+        if done:
+            return "[%s] Best focus %f +/- %f after %d images\n" % (side.upper(), minX, error, len(files))
+        return "[%s] Adaptive loop ended after %d images without reaching the requested accuracy\n" % (side.upper(), len(files))
+
+    def waitForImage(self, prefix, before, timeout=10):
+        """
+        Waits until focus images that are not in before appear on disk, and returns them.
+        Returns an empty list after timeout seconds, or at once without KTL.
+        """
+        if useKTL is False:
+            return []
+        t0 = time.time()
+        while True:
+            new = [f for f in self.focusFiles(prefix) if f not in before]
+            if new:
+                return new
+            if time.time() - t0 > timeout:
+                log.warning("No new %s image after %d s" % (prefix, timeout))
+                return new
+            time.sleep(0.2)
+
+    def goib(self, telemetry=None):
+        """
+        Takes a blue exposure; the phases are timestamped in telemetry (FocusTelemetry.LoopTelemetry)
+        """
         log.info("Running goib")
         if useKTL is False:
             time.sleep(1)
@@ -740,13 +1243,22 @@ class MyWindow(QWidget):
 
         # start the exposure
         expose.write(True, wait=True)
+        if telemetry:
+            telemetry.mark('expose')
 
         # wait for end of exposure
         wcrate.waitFor('==True')
+        if telemetry:
+            telemetry.mark('shutter')
         wcrate.waitFor('==False', timeout = 200)
         rserv.waitFor('==False', timeout = 200)
+        if telemetry:
+            telemetry.mark('readout')
 
-    def goir(self):
+    def goir(self, telemetry=None):
+        """
+        Takes a red exposure; the phases are timestamped in telemetry (FocusTelemetry.LoopTelemetry)
+        """
         log.info("Running goir")
         if useKTL is False:
             time.sleep(1)
@@ -773,10 +1285,16 @@ class MyWindow(QWidget):
 
         # start the exposure
         expose.write(True, wait=True)
+        if telemetry:
+            telemetry.mark('expose')
 
         # wait for end of exposure
         wcrate.waitFor('==True')
+        if telemetry:
+            telemetry.mark('shutter')
         observip.waitFor('==False', timeout = 200)
+        if telemetry:
+            telemetry.mark('readout')
 
 
     def run_command(self, command):
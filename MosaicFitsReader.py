@@ -2,10 +2,35 @@ import astropy.io.fits as pyfits
 import numpy as np
 import re
 
+def binImage(data, f):
+    '''
+    Averages f x f pixels; rows and columns that do not fill a bin are dropped
+    '''
+    h, w = data.shape[0] // f, data.shape[1] // f
+    return data[:h*f, :w*f].reshape(h, f, w, f).mean(axis=(1, 3), dtype=np.float32)
+
+def makePyramid(binned, factor, minSize=64):
+    '''
+    Returns a list of (binning factor, image), starting from an image already
+    binned by factor and halving the size until it is smaller than minSize
+    '''
+    levels = [(factor, binned)]
+    while min(levels[-1][1].shape) >= 2 * minSize:
+        f, img = levels[-1]
+        levels.append((2 * f, binImage(img, 2)))
+    return levels
+
 class MosaicFitsReader:
-    def __init__(self, fname=None):
+    def __init__(self, fname=None, readData=True):
+        """
+        With readData False only the headers are read, and the pixels
+        can then be read with readCuts.
+        """
         self.fname = fname
-        self.data = self.read(fname)
+        if readData:
+            self.data = self.read(fname)
+        else:
+            self.open(fname)
     
     def getImage(self):
         return self.data    
@@ -22,73 +47,215 @@ class MosaicFitsReader:
 
         return reorder(reg[0], reg[1]), reorder(reg[2], reg[3])
 
-    def read (self, fname):
+    def open (self, fname):
         """
-        Reads image data from a DEIMOS fits file.
-        Returns the raw image data.
+        Opens the file and works out the mosaic geometry from the headers.
+        No pixel data is read.
         """
-        
-        #open
-        print("reading...")
         hdus = pyfits.open(fname, ignore_missing_end=True)
         #needed hdr vals
         self.hdrs = hdus
         hdr0 = hdus[0].header
         binning  = hdr0['BINNING'].split(',')
-        precol   = int(hdr0['PRECOL'])   // int(binning[0])
-        postpix  = int(hdr0['POSTPIX'])  // int(binning[0])
-        preline  = int(hdr0['PRELINE'])  // int(binning[1])
-        postline = int(hdr0['POSTLINE']) // int(binning[1])
+        self.binning = (int(binning[0]), int(binning[-1]))
+        self.precol   = int(hdr0['PRECOL'])   // int(binning[0])
+        self.postpix  = int(hdr0['POSTPIX'])  // int(binning[0])
+        self.preline  = int(hdr0['PRELINE'])  // int(binning[1])
+        self.postline = int(hdr0['POSTLINE']) // int(binning[1])
 
         #get extension order (uses DETSEC keyword)
         ext_order = self.get_ext_data_order(hdus)
         assert ext_order, "ERROR: Could not determine extended data order"
 
-        #loop thru extended headers in order, create png and add to list in order
-        vmin = None
-        vmax = None
+        #a windowed readout can leave amplifiers with no pixels outside the prescan/overscan
+        ext_order = [ext for ext in ext_order
+                     if hdus[ext].header['NAXIS1'] - self.precol - self.postpix > 0 and hdus[ext].header['NAXIS2'] > 0]
+        assert ext_order, "ERROR: No amplifier has data pixels"
+
+        #shapes of the extensions, from the headers (no data is read yet)
+        self.ampShapes = [(hdus[ext].header['NAXIS2'], hdus[ext].header['NAXIS1']) for ext in ext_order]
+        self.ampWidths = [sh[1] - self.precol - self.postpix for sh in self.ampShapes]
+
+        #first mosaic column of each extension, used by getAmp
+        self.ampStarts = list(np.cumsum([0] + self.ampWidths[:-1]))
+        self.ampExts = list(ext_order)
+        self.shape = (self.ampShapes[0][0], sum(self.ampWidths))
+
+        #position of the amplifiers on the detector, in unbinned pixels, from DETSEC:
+        #windowed readouts start away from the detector origin, and may skip
+        #part of the detector between two amplifiers
+        detsecs = [self.get_detsec_data(hdus[ext].header['DETSEC']) for ext in ext_order]
+        self.ampDetStarts = [min(ds[0], ds[1]) - 1 for ds in detsecs]
+        self.detRowStart = min(min(ds[2], ds[3]) for ds in detsecs) - 1
+
+    def _ampBlocks (self, rowRange=None):
+        """
+        Loops thru the extensions in file order (gzip streams are read forward)
+        and yields, one block of rows at a time:
+        amp index, raw block, bias of each row, first and last mosaic row of the block,
+        and whether the block is flipped up/down and left/right according to DETSEC.
+        rowRange (first, last + 1) limits the mosaic rows that are read.
+        """
+        postpix = self.postpix
+        for i, ext in sorted(enumerate(self.ampExts), key=lambda x: x[1]):
+            hdu = self.hdrs[ext]
+            nrows, ncols = self.ampShapes[i]
+            ds = self.get_detsec_data(hdu.header['DETSEC'])
+            flipx = bool(ds and ds[0] > ds[1])
+            flipy = bool(ds and ds[2] > ds[3])
+
+            #raw rows needed for the requested mosaic rows
+            m0, m1 = rowRange if rowRange else (0, nrows)
+            r0, r1 = (nrows - m1, nrows - m0) if flipy else (m0, m1)
+
+            for b0, b1, data in self._readBlocks(hdu, r0, r1):
+                #calc bias array from postpix area
+                y1 = ncols - postpix + 1
+                y2 = ncols - 1
+                bias = np.median(data[:, y1:y2], axis=1)
+                bias = np.array(bias, dtype=np.int64)
+                if flipy:
+                    yield i, data, bias, nrows - b1 - m0, nrows - b0 - m0, flipy, flipx
+                else:
+                    yield i, data, bias, b0 - m0, b1 - m0, flipy, flipx
+
+    def read (self, fname):
+        """
+        Reads image data from a DEIMOS fits file.
+        Plain, gzipped (.gz) and tile-compressed (fpack .fz) files are supported.
+        Returns the raw image data.
+        """
+        
+        #open
+        print("reading...")
+        self.open(fname)
+        precol, postpix = self.precol, self.postpix
+
+        #fill the mosaic one block of rows at a time
         alldata = None
-        for i, ext in enumerate(ext_order):
-            data = hdus[ext].data
-            hdr  = hdus[ext].header
-
-            #calc bias array from postpix area
-            sh = data.shape
-            x1 = 0
-            x2 = sh[0]
-            y1 = sh[1] - postpix + 1
-            y2 = sh[1] - 1
-            bias = np.median(data[x1:x2, y1:y2], axis=1)
-            bias = np.array(bias, dtype=np.int64)
-
-            #subtract bias
-            data = data - bias[:,None]
-
-            #get min max of each ext (not including pre/post pixels)
-            #NOTE: using sample box that is 90% of full area
-            #todo: should we take an average min/max of each ext for balancing?
-            sh = data.shape
-            x1 = int(preline          + (sh[0] * 0.10))
-            x2 = int(sh[0] - postline - (sh[0] * 0.10))
-            y1 = int(precol           + (sh[1] * 0.10))
-            y2 = int(sh[1] - postpix  - (sh[1] * 0.10))
-
-            #remove pre/post pix columns
-            data = data[:,precol:data.shape[1]-postpix]
-
-            #flip data left/right 
-            #NOTE: This should come after removing pre/post pixels
-            ds = self.get_detsec_data(hdr['DETSEC'])
-            if ds and ds[0] > ds[1]: 
+        for i, data, bias, y0, y1, flipy, flipx in self._ampBlocks():
+            x0 = self.ampStarts[i]
+            ncols = self.ampShapes[i][1]
+
+            #remove pre/post pix columns and subtract bias
+            data = data[:,precol:ncols-postpix] - bias[:,None]
+
+            if alldata is None:
+                alldata = np.empty(self.shape, dtype=data.dtype)
+            if flipx:
                 data = np.fliplr(data)
-            if ds and ds[2] > ds[3]: 
+            if flipy:
                 data = np.flipud(data)
-
-            #concatenate horizontally
-            if i==0: alldata = data
-            else   : alldata = np.append(alldata, data, axis=1)
+            alldata[y0:y1, x0:x0+self.ampWidths[i]] = data
         return alldata
-        
+
+    def readCuts (self, columns, rowRange=None, previewFactor=None):
+        """
+        Region of interest read: returns only the given mosaic columns,
+        bias-subtracted and flipped as in read, as an array (rows, len(columns)).
+        rowRange (first, last + 1) limits the mosaic rows.
+        The full mosaic is never assembled; only one block of rows of one
+        extension is in memory at a time.
+        With previewFactor, a preview pyramid is built from the same blocks
+        and stored in self.preview (see makePyramid).
+        The raw values are compared with saturationLevel, and the saturated
+        pixels of the cuts are flagged in self.saturated.
+        """
+        if not hasattr(self, 'shape'):
+            self.open(self.fname)
+        columns = np.asarray(columns, dtype=int)
+        nrows = (rowRange[1] - rowRange[0]) if rowRange else self.shape[0]
+        cuts = None
+        self.saturated = np.zeros((nrows, len(columns)), dtype=bool)
+        amps = np.searchsorted(self.ampStarts, columns, side='right') - 1
+        if previewFactor:
+            f = previewFactor
+            binned = np.zeros((nrows // f, self.shape[1] // f), dtype=np.float32)
+        for i, data, bias, y0, y1, flipy, flipx in self._ampBlocks(rowRange):
+            if previewFactor:
+                block = data[:, self.precol:self.ampShapes[i][1]-self.postpix] - bias[:,None]
+                if flipx:
+                    block = np.fliplr(block)
+                if flipy:
+                    block = np.flipud(block)
+                block = binImage(block, f)
+                px0 = self.ampStarts[i] // f
+                py0 = y0 // f
+                block = block[:binned.shape[0]-py0, :binned.shape[1]-px0]
+                binned[py0:py0+block.shape[0], px0:px0+block.shape[1]] = block
+            sel = np.nonzero(amps == i)[0]
+            if len(sel) == 0:
+                continue
+            local = columns[sel] - self.ampStarts[i]
+            if flipx:
+                local = self.ampWidths[i] - 1 - local
+            raw = data[:, self.precol + local]
+            saturated = raw >= self.saturationLevel(i)
+            data = raw - bias[:,None]
+            if cuts is None:
+                cuts = np.empty((nrows, len(columns)), dtype=data.dtype)
+            if flipy:
+                data = np.flipud(data)
+                saturated = np.flipud(saturated)
+            cuts[y0:y1, sel] = data
+            self.saturated[y0:y1, sel] = saturated
+        if previewFactor:
+            self.preview = makePyramid(binned, previewFactor)
+        return cuts
+
+    def iterAmps (self, rowRange=None):
+        """
+        Per-amplifier read: yields one amplifier at a time, in file order,
+        (amp index, first mosaic column, data, saturated).
+        data is the amplifier without its prescan/overscan columns, bias-subtracted
+        and flipped as in read; saturated flags the pixels at the saturation level.
+        The amplifiers are not glued into a mosaic, and only one is in memory at a time.
+        """
+        precol, postpix = self.precol, self.postpix
+        nrows = (rowRange[1] - rowRange[0]) if rowRange else self.shape[0]
+        amp = None
+        for i, data, bias, y0, y1, flipy, flipx in self._ampBlocks(rowRange):
+            if i != amp:
+                if amp is not None:
+                    yield amp, self.ampStarts[amp], ampData, saturated
+                amp = i
+                ampData = None
+                saturated = np.zeros((nrows, self.ampWidths[i]), dtype=bool)
+            raw = data[:, precol:self.ampShapes[i][1]-postpix]
+            block = raw - bias[:,None]
+            sat = raw >= self.saturationLevel(i)
+            if ampData is None:
+                ampData = np.empty((nrows, self.ampWidths[i]), dtype=block.dtype)
+            if flipx:
+                block, sat = np.fliplr(block), np.fliplr(sat)
+            if flipy:
+                block, sat = np.flipud(block), np.flipud(sat)
+            ampData[y0:y1] = block
+            saturated[y0:y1] = sat
+        if amp is not None:
+            yield amp, self.ampStarts[amp], ampData, saturated
+
+    def _readBlocks(self, hdu, first, last, blockRows=256):
+        '''
+        Reads rows first to last-1 of an image extension in blocks of rows,
+        yields (first row, last row + 1, data).
+        Tile-compressed (fpack) extensions are decompressed tile by tile through
+        section, with blocks aligned to the tile height. A gzip stream cannot be
+        sliced without decompressing it again from the start, so gzipped files are
+        read one extension at a time, and the extension is released after use.
+        '''
+        info = hdu.fileinfo()
+        if info and info['file'].compression == 'gzip':
+            yield first, last, hdu.data[first:last]
+            del hdu.data
+            return
+        if isinstance(hdu, pyfits.CompImageHDU):
+            tileRows = int(hdu.tile_shape[0])
+            blockRows = max(tileRows, blockRows // tileRows * tileRows)
+        for r0 in range(first, last, blockRows):
+            r1 = min(r0 + blockRows, last)
+            yield r0, r1, hdu.section[r0:r1, :]
+
     def get_ext_data_order(self,hdus):
         '''
         Use DETSEC keyword to figure out true order of extension data for horizontal tiling
@@ -119,6 +286,35 @@ class MosaicFitsReader:
             y2 = int(match.groups(1)[3])
             return [x1, x2, y1, y2]
 
+    def saturationLevel(self, amp):
+        '''
+        Raw saturation level of an amplifier (index in the mosaic order):
+        the SATURATE keyword of its extension or of the primary header,
+        or else the largest value of the 16 bit data
+        '''
+        hdr = self.hdrs[self.ampExts[amp]].header
+        value = hdr.get('SATURATE', self.hdrs[0].header.get('SATURATE'))
+        if value is not None:
+            return float(value)
+        if hdr.get('BZERO', 0) == 32768:
+            return 65535
+        return 32767
+
+    def detectorColumns(self, columns):
+        '''
+        Detector columns (unbinned pixels from the detector origin, first pixel of the bin) of mosaic columns
+        '''
+        columns = np.asarray(columns, dtype=int)
+        amps = np.searchsorted(self.ampStarts, columns, side='right') - 1
+        return (columns - np.array(self.ampStarts)[amps]) * self.binning[0] + np.array(self.ampDetStarts)[amps]
+
+    def getAmp(self, column):
+        '''
+        Returns the extension number of the amplifier that a mosaic column comes from
+        '''
+        i = np.searchsorted(self.ampStarts, column, side='right') - 1
+        return self.ampExts[max(i, 0)]
+
     def readCut (self, fname):
         img = self.read(fname)
         minmax = self.minmax
@@ -5,27 +5,96 @@
 
 
 
-import MosaicFitsReader as mfr
-from scipy import stats
-from scipy.ndimage.filters import gaussian_filter
 import numpy as np
 import math
+from FocusResults import FocusResults
+
+# MosaicFitsReader (astropy) and scipy are slow to import; they are loaded
+# the first time an analysis runs, or in the background through preload()
+
+def preload():
+    """
+    Imports the heavy modules used by the analysis, so that the first
+    analysis does not pay for them.
+    """
+    import MosaicFitsReader
+    import scipy.ndimage
+
+# index tables used by centroid, one per window length
+indexTables = {}
 
 def centroid(arr):
     """
     One step 1D centroiding algo.
-    Returns centroid position and standard deviation
+    Returns centroid position and standard deviation, or None if there is no signal
+    above the median.
+    The variance is computed in two passes (around the centroid),
+    so it cannot go negative.
     """
     l = arr.shape[0]
-    ixs = np.arange(l)
+    ixs = indexTables.get(l)
+    if ixs is None:
+        ixs = indexTables[l] = np.arange(l, dtype=float)
     arr = arr - np.median(arr)
     arr = np.where(arr < 0, 0, arr)    
-    ixs2 = ixs * ixs
     sumarr = arr.sum()
+    if sumarr <= 0:
+        return None
     cen = np.dot(arr, ixs)/sumarr
-    return cen, math.sqrt(np.dot(arr, ixs2)/sumarr - cen * cen)
+    dx = ixs - cen
+    return cen, math.sqrt(np.dot(arr, dx * dx)/sumarr)
+
+class CentroidTable:
+    """
+    Prefix sums of the 0th, 1st and 2nd moments of the columns of an image,
+    so that the moments of any window come out in O(1).
 
-def centroidLoop(arr, fromIdx, toIdx, nLoops=10, epsilon=1E-1):
+    The background is one level per column (its median), subtracted and
+    clamped at zero once per pixel, instead of the median of each window as in
+    centroid: the clamping cannot be undone from prefix sums otherwise.
+    The widths are then somewhat larger than with centroid, whose window median
+    is lifted by the wings of a wide line, but the best focus is the same.
+    Positions are counted from the center of the column, to limit the
+    cancellation in the variance.
+    """
+    def __init__(self, p0, p1, p2, offset):
+        self.p0, self.p1, self.p2 = p0, p1, p2
+        self.offset = offset
+
+    @classmethod
+    def build(cls, cuts):
+        """
+        Tables for all the columns of cuts (rows, columns) at once
+        """
+        cuts = np.asarray(cuts, dtype=float)
+        signal = cuts - np.median(cuts, axis=0)
+        signal[signal < 0] = 0
+        offset = cuts.shape[0] / 2
+        ixs = (np.arange(cuts.shape[0], dtype=float) - offset)[:, None]
+        zero = np.zeros((1, cuts.shape[1]))
+        p0 = np.concatenate([zero, np.cumsum(signal, axis=0)])
+        p1 = np.concatenate([zero, np.cumsum(signal * ixs, axis=0)])
+        p2 = np.concatenate([zero, np.cumsum(signal * ixs * ixs, axis=0)])
+        return cls(p0, p1, p2, offset)
+
+    def column(self, j):
+        return CentroidTable(self.p0[:, j], self.p1[:, j], self.p2[:, j], self.offset)
+
+    def centroid(self, fromIdx, toIdx):
+        """
+        Same as centroid(arr[fromIdx:toIdx]), with the background of the table.
+        Returns None if the window has no signal
+        """
+        s0 = self.p0[toIdx] - self.p0[fromIdx]
+        s1 = self.p1[toIdx] - self.p1[fromIdx]
+        s2 = self.p2[toIdx] - self.p2[fromIdx]
+        if s0 <= 0:
+            return None
+        cen = s1 / s0
+        var = s2 / s0 - cen * cen
+        return cen + self.offset - fromIdx, math.sqrt(max(var, 0))
+
+def centroidLoop(arr, fromIdx, toIdx, nLoops=10, epsilon=1E-1, table=None):
     """
     Finds the centroid by repeatedly centering and recalculating 
     until the centroid position changes by less than epsilon.
@@ -36,6 +105,7 @@ def centroidLoop(arr, fromIdx, toIdx, nLoops=10, epsilon=1E-1):
     centroid position: position relative to input array, ie. 0 is first pixel
     standard deviation: standard deviation as calculated by the centroid algorithm (assumed Gaussian stats)
     iterations: number of iterations needed until change is less than epsilon
+    With a CentroidTable of arr, each iteration is a table lookup.
     """
     def limit(x):
         if x < 0: return 0
@@ -48,7 +118,13 @@ def centroidLoop(arr, fromIdx, toIdx, nLoops=10, epsilon=1E-1):
     for i in range(nLoops):
         fromIdx = int(limit(fromIdx))
         toIdx = int(limit(fromIdx + radius + radius + 0.5))
-        pos, cenStd = centroid(arr[fromIdx:toIdx])
+        if table is None:
+            found = centroid(arr[fromIdx:toIdx])
+        else:
+            found = table.centroid(fromIdx, toIdx)
+        if found is None:
+            return -1, 0, 0, i
+        pos, cenStd = found
         cenPos = pos + fromIdx
         #print (i, fromIdx, toIdx, cenPos, cenStd, lastCenPos)
         
@@ -64,27 +140,185 @@ def centroidLoop(arr, fromIdx, toIdx, nLoops=10, epsilon=1E-1):
         
     return -1, cenPos, cenStd, i
 
-def findWidths (arr1d, size=60):
+def gaussianModel(x, p):
+    """
+    Gaussian plus constant background, evaluated for a batch of parameter sets.
+
+    x: pixel positions, shape (m,)
+    p: parameters (amplitude, center, sigma, background), shape (n, 4)
+    Returns the model (n, m) and its jacobian (n, m, 4)
+    """
+    amp, cen, sig, bkg = p[:, 0:1], p[:, 1:2], p[:, 2:3], p[:, 3:4]
+    dx = x[None, :] - cen
+    e = np.exp(-0.5 * dx * dx / (sig * sig))
+    model = amp * e + bkg
+    jac = np.empty(model.shape + (4,))
+    jac[..., 0] = e
+    jac[..., 1] = amp * e * dx / (sig * sig)
+    jac[..., 2] = amp * e * dx * dx / (sig * sig * sig)
+    jac[..., 3] = 1
+    return model, jac
+
+def fitGaussians(segments, cens, stds, nLoops=20):
+    """
+    Fits a Gaussian plus constant to every row of segments at once,
+    with a Levenberg-Marquardt solver vectorized across the rows.
+
+    segments: 2D array, one line profile per row
+    cens, stds: initial center and standard deviation for each row (e.g. from centroid)
+
+    Returns status, center, sigma (one value per row)
+    status: True if the fit converged to a line inside the segment
+    """
+    segments = np.asarray(segments, dtype=float)
+    n, m = segments.shape
+    x = np.arange(m, dtype=float)
+    bkg = np.median(segments, axis=1)
+    p = np.empty((n, 4))
+    p[:, 0] = segments.max(axis=1) - bkg
+    p[:, 1] = cens
+    p[:, 2] = np.clip(stds, 0.5, m / 3)
+    p[:, 3] = bkg
+    lam = np.full(n, 1E-3)
+    eye = np.eye(4)
+
+    model, jac = gaussianModel(x, p)
+    res = segments - model
+    chi2 = (res * res).sum(axis=1)
+    for i in range(nLoops):
+        jtj = np.einsum('nmi,nmj->nij', jac, jac)
+        grad = np.einsum('nmi,nm->ni', jac, res)
+        diag = jtj * eye
+        step = np.linalg.solve(jtj + lam[:, None, None] * diag + 1E-12 * eye, grad[..., None])[..., 0]
+        pNew = p + step
+        modelNew, jacNew = gaussianModel(x, pNew)
+        resNew = segments - modelNew
+        chi2New = (resNew * resNew).sum(axis=1)
+        better = np.isfinite(chi2New) & (chi2New < chi2)
+        p = np.where(better[:, None], pNew, p)
+        jac = np.where(better[:, None, None], jacNew, jac)
+        res = np.where(better[:, None], resNew, res)
+        chi2 = np.where(better, chi2New, chi2)
+        lam = np.where(better, lam / 10, lam * 10)
+
+    amp, cen, sig = p[:, 0], p[:, 1], np.abs(p[:, 2])
+    status = np.isfinite(p).all(axis=1) & (amp > 0) & (cen >= 0) & (cen < m) & (sig < m / 3)
+    return status, cen, sig
+
+def findLines(img, columns, size, nSigma=5):
+    """
+    Finds the arc lines in the selected columns of an image, all columns at once.
+
+    Each column is lightly smoothed, then the local maxima that stand nSigma
+    above the column background are kept. Lines that have another line
+    within size/2 pixels are dropped, since a window of length size
+    around them would contain both.
+
+    Returns a dictionary {column: array of line positions}
+    """
+    from scipy.ndimage import gaussian_filter1d
+    columns = list(columns)
+    cuts = gaussian_filter1d(np.asarray(img[:, columns], dtype=float), sigma=1, axis=0)
+    bkg = np.median(cuts, axis=0)
+    noise = 1.4826 * np.median(np.abs(cuts - bkg), axis=0)
+    inner = cuts[1:-1]
+    peaks = (inner > cuts[:-2]) & (inner >= cuts[2:]) & (inner > bkg + nSigma * noise)
+    index = {}
+    for i, col in enumerate(columns):
+        pos = np.nonzero(peaks[:, i])[0] + 1
+        gaps = np.diff(pos)
+        isolated = np.ones(len(pos), dtype=bool)
+        isolated[1:] &= gaps > size/2
+        isolated[:-1] &= gaps > size/2
+        pos = pos[isolated]
+        index[col] = pos[(pos >= size//2) & (pos < cuts.shape[0] - size//2)]
+    return index
+
+def maskCuts(cuts, saturated, nSigma=5, fraction=0.5, grow=2, reach=3, support=0.3):
+    """
+    Cleans the sampled columns of an image before the widths are measured, all columns at once.
+
+    Cosmic rays: a pixel that stands above the median of the 5 pixels around it
+    by nSigma times the noise, and by more than fraction of its own signal, is
+    a candidate. Sharp (in focus, or binned) arc lines pass this test too, so a
+    candidate is only replaced with the median if the neighbouring sampled columns
+    have no signal within reach rows of it, above support times its own signal:
+    an arc line crosses all the columns, a cosmic ray hits only one.
+    Saturated pixels (from MosaicFitsReader.readCuts) are grown by grow pixels
+    and returned as a mask, to reject the windows that contain them.
+
+    Returns the cleaned cuts, the mask of bad pixels, the number of cosmic ray pixels
+    """
+    from scipy.ndimage import median_filter, maximum_filter1d, binary_dilation
+    cuts = np.asarray(cuts, dtype=float)
+    med = median_filter(cuts, size=(5, 1), mode='nearest')
+    resid = cuts - med
+    # noise from the differences of consecutive pixels: the residuals from the
+    # median include the pixel itself, and their spread underestimates the noise
+    noise = 1.4826 * np.median(np.abs(np.diff(cuts, axis=0)), axis=0) / math.sqrt(2)
+    signal = cuts - np.median(cuts, axis=0)
+    candidates = (resid > nSigma * noise) & (resid > fraction * signal)
+    # brightest signal within reach rows, in each column
+    nearby = maximum_filter1d(signal, size=2 * reach + 1, axis=0, mode='nearest')
+    supported = np.zeros(cuts.shape, dtype=bool)
+    supported[:, 1:] |= nearby[:, :-1] > support * signal[:, 1:]
+    supported[:, :-1] |= nearby[:, 1:] > support * signal[:, :-1]
+    cosmics = candidates & ~supported
+    cleaned = np.where(cosmics, med, cuts)
+    bad = binary_dilation(saturated, structure=np.ones((2 * grow + 1, 1), dtype=bool))
+    return cleaned, bad, int(cosmics.sum())
+
+def findWidths (arr1d, size=60, method='moment', lines=None, withPositions=False, mask=None, table=None):
     """
     Divides the input array in segments of size length.
+    If lines (positions from findLines) are given, the segments are centred
+    on those lines instead of being cut blindly from the start of the array.
+    Segments whose final window contains a pixel flagged in mask are rejected;
+    they still count in the total, as if they were in the widest half.
+    table (a CentroidTable of arr1d) is passed on to centroidLoop.
     For each segment, finds the centroid, if centroid is good then record it.
+    With method 'gaussian' the lines found this way are then fitted
+    with Gaussian profiles, all in one batch, and the fitted sigma is used instead.
     Sorts the centroids by standard deviation.
     Returns the smallest half of the standard deviation
+    With withPositions, returns the widths and the matching line positions.
     """
     out = []
-    for x in range(0, len(arr1d)-size, size):
+    cens = []
+    nMasked = 0
+    if lines is None:
+        starts = range(0, len(arr1d)-size, size)
+    else:
+        starts = [int(x) - size//2 for x in lines]
+    for x in starts:
         try:
-            ok, cen, std, idx = centroidLoop(arr1d, x, x+size)     
-        except:
-            pass
+            ok, cen, std, idx = centroidLoop(arr1d, x, x+size, table=table)
+        except ValueError:
+            # not a number in the window: no width for this segment
+            continue
         #print (res)
+        if ok == 0 and mask is not None and mask[max(int(cen - size/2), 0):int(cen + size/2) + 1].any():
+            nMasked += 1
+            continue
         if ok == 0:
             out.append(std)
+            cens.append(cen)
     #print (out)
     if len(out) <= 0:
-        return []
-    out = sorted(out)
-    return out[:len(out)//2]
+        return ([], []) if withPositions else []
+    if method == 'gaussian':
+        cens = np.array(cens)
+        starts = np.clip(np.round(cens).astype(int) - size//2, 0, len(arr1d) - size)
+        segments = arr1d[starts[:, None] + np.arange(size)]
+        ok, cen, std = fitGaussians(segments, cens - starts, np.array(out))
+        out = list(std[ok])
+        cens = list((cen + starts)[ok])
+        if len(out) <= 0:
+            return ([], []) if withPositions else []
+    order = np.argsort(out, kind='stable')[:(len(out) + nMasked)//2]
+    if withPositions:
+        return [out[i] for i in order], [cens[i] for i in order]
+    return [out[i] for i in order]
 
 def makePairs(data):
     """
@@ -117,66 +351,293 @@ def asympFunc(m, b):
         return m * x + b
     return f
 
+def readFrame(fname, previewFactor=None):
+    """
+    I/O part of measureWidths: reads the headers and the sampled columns of one image.
+    Returns None if the image has no focus keyword, otherwise a dictionary with
+    file, focus, side, shape, profile (AnalysisProfiles.AnalysisProfile),
+    columns (mosaic columns sampled), detColumns and rowOffset (position of the
+    sampled columns and of the first row on the detector, in unbinned pixels), amps (extension of each column),
+    cuts (rows, columns), saturated (mask of cuts) and, with previewFactor, pyramid.
+    """
+    import MosaicFitsReader as mfr
+    import AnalysisProfiles
+    print("Attempting to open file %s\n" % fname)
+    # only the headers are read here, the pixels are read below with readCuts
+    ffile = mfr.MosaicFitsReader(fname, readData=False)
+    instrument = ffile.getKeyword('INSTRUME')
+    if "BLU" in instrument:
+        side = 'blue'
+        Focus = ffile.getKeyword('BLUFOCUS')
+    else:
+        side = 'red'
+        Focus = ffile.getKeyword('REDFOCUS')
+    if Focus == None:
+        return None
+    shape = ffile.shape
+    print("Shape of the array: %d x %d" % (shape[0], shape[1]))
+    profile = AnalysisProfiles.profileFor(side, ffile.getKeyword('BINNING'), shape)
+    print(profile)
+    # read only the sampled columns: cuts[:, j] is mosaic column columns[j]
+    columns = profile.columns()
+    cuts = ffile.readCuts(columns, previewFactor=previewFactor)
+    frame = {'file': fname, 'focus': Focus, 'side': side, 'shape': shape, 'profile': profile, 'columns': columns,
+             'detColumns': list(ffile.detectorColumns(columns)), 'rowOffset': ffile.detRowStart,
+             'amps': [ffile.getAmp(c) for c in columns], 'cuts': cuts, 'saturated': ffile.saturated}
+    if previewFactor:
+        frame['pyramid'] = ffile.preview
+    return frame
+
+def measureFrame(frame, lineIndex=None, method='moment', kernel='reference', blind=False):
+    """
+    Compute part of measureWidths: measures the widths of a frame from readFrame.
+    The line index is built from this frame if lineIndex is None.
+    With blind, the cuts are neither cleaned nor masked and the widths are measured
+    in fixed segments, without the line index, as it was done before those were added.
+    Returns a FocusResults with the widths of this frame, and the line index used.
+    The positions of the widths are recorded in detector coordinates, in unbinned
+    pixels, so that binned and unbinned frames can be compared and mapped together.
+    """
+    from scipy.ndimage import gaussian_filter
+    out = FocusResults()
+    fileIndex = out.addFile(frame['file'])
+    Focus, side, columns, profile = frame['focus'], frame['side'], frame['columns'], frame['profile']
+    length = profile.window
+    if blind:
+        img, bad = np.asarray(frame['cuts'], dtype=float), None
+    else:
+        img, bad, nCosmics = maskCuts(frame['cuts'], frame['saturated'])
+        print("Saturated pixels: %d, cosmic ray pixels: %d" % (frame['saturated'].sum(), nCosmics))
+        if lineIndex is None:
+            lineIndex = findLines(img, range(len(columns)), size=int(length))
+            print("Found %d arc lines" % sum(len(x) for x in lineIndex.values()))
+    tables = CentroidTable.build(img) if kernel == 'table' else None
+    for j, row in enumerate(columns):
+        cut1d = img[:,j]
+        if np.max(gaussian_filter(cut1d,sigma=profile.smooth))> 0:
+            widths, cens = findWidths(cut1d, size=int(length), method=method, lines=None if blind else lineIndex.get(j),
+                                      withPositions=True, mask=None if blind else bad[:,j],
+                                      table=tables.column(j) if tables is not None else None)
+            widths = np.array(widths)
+            if len(widths)>=profile.minWidths:
+                #clippedWidths,low,upp = stats.sigmaclip(widths,low=4,high=2)
+                keep = clipMask(widths, high=profile.clipHigh)
+                clippedWidths = widths[keep]
+                if clippedWidths.std()<profile.maxScatter and np.median(clippedWidths)<profile.maxWidth:
+                    #print(row,Focus,clippedWidths.mean(),low,upp,clippedWidths.std())
+                    # center of the binned row, in unbinned detector pixels
+                    rows = (np.array(cens)[keep] + 0.5) * profile.binning[1] - 0.5 + frame['rowOffset']
+                    out.append(Focus, clippedWidths, rows, frame['detColumns'][j],
+                               frame['amps'][j], fileIndex, side)
+    return out, lineIndex
+
+def previewInfo(frame, lineIndex):
+    """
+    Quick-look description of a frame read with a previewFactor, for the GUI
+    """
+    return {'file': frame['file'], 'pyramid': frame['pyramid'], 'columns': frame['columns'],
+            'lines': [lineIndex.get(j, []) for j in range(len(frame['columns']))],
+            'size': frame['profile'].window}
+
 """
 Shui's version
 For all input files, finds the standard deviations of the centroids.
 These standard deviations are assosicated with the focus. 
+method selects the width estimator: 'moment' (centroid) or 'gaussian' (fitGaussians).
+The line positions are found once on the first image (findLines) and reused
+for the whole sequence, since all the frames see the same arc spectrum.
 
-Output is stored in out[].
+Output is stored in a FocusResults store: focus, width, detector row and column,
+amplifier (extension), file index and side of each width.
+kernel 'table' centroids with CentroidTable lookups instead of the reference centroid.
+If out is given, the measurements are appended to it.
+If preview is a dictionary, it is filled with a quick-look of the last file:
+file, pyramid (MosaicFitsReader.makePyramid), sampled columns, line positions and window size.
+callback(frameResults), if given, is called with the widths of each file as soon as it is measured.
+FocusPipeline runs the same two steps (readFrame, measureFrame) as a streaming pipeline.
 """
-def measureWidths(files):
-    minrow = 200
-    maxrow = 3800
-    out = []
+def measureWidths(files, method='moment', out=None, preview=None, kernel='reference', callback=None):
+    if out is None:
+        out = FocusResults()
+    lineIndex = None
     print("Received this list of files: %s" % str(files))
     for f in files:
-        fname = f
-
-    #for f in range(8,15): #LongSlit blue
-    #    fname = "test_images/longslit/bfoc%04d.fits" % f
-    
-    #for f in range(1,7): #LongSlit red
-    #    fname = "test_images/longslit/rfoc%04d.fits" % f
-    
-        print("Attempting to open file %s\n" % f)
-        ffile = mfr.MosaicFitsReader(fname)
-        img = np.array(ffile.data)
-        instrument = ffile.getKeyword('INSTRUME')
-        if "BLU" in instrument:
-            Focus = ffile.getKeyword('BLUFOCUS')
-        else:
-            Focus = ffile.getKeyword('REDFOCUS')
-        if Focus == None:
+        # the quick-look pyramid is only built for the last file
+        makePreview = preview is not None and f == files[-1]
+        frame = readFrame(f, previewFactor=8 if makePreview else None)
+        if frame is None:
             continue
-        print("Shape of the array: %d x %d" % (img.shape[0], img.shape[1]))
-        print("Setting maxrow to %d" % (img.shape[0]-200))
-        maxrow = img.shape[1]-200
-        for row in range(minrow,maxrow,100):
-            cut1d = img[:,row]
-            if np.max(gaussian_filter(cut1d,sigma=20))> 0:
-                length = cut1d.shape[0]/60
-                widths = np.array(findWidths(cut1d, size=int(length)))
-                if len(widths)>5:
-                    #clippedWidths,low,upp = stats.sigmaclip(widths,low=4,high=2)
-                    clippedWidths = absoluteClip(widths, high=1)
-                    if clippedWidths.std()<1 and np.median(clippedWidths)<5:
-                        #print(row,Focus,clippedWidths.mean(),low,upp,clippedWidths.std())
-                        out.append((Focus, clippedWidths))
+        res, lineIndex = measureFrame(frame, lineIndex, method, kernel)
+        out.extend(res)
+        if makePreview:
+            preview.update(previewInfo(frame, lineIndex))
+        if callback:
+            callback(res)
     return out
 
 
-def absoluteClip(widths, high):
+# columns closer than this to the edge of an amplifier are not measured
+ampSeam = 16
+
+def readAmpFrames(fname, seam=ampSeam):
+    """
+    Per-amplifier version of readFrame: yields one frame per amplifier, with the
+    same keys as readFrame, so that each can be given to measureFrame on its own.
+    The amplifiers are read separately (MosaicFitsReader.iterAmps), the mosaic
+    is not assembled. The sampled columns are those of readFrame, without the
+    ones within seam (unbinned) pixels of an amplifier edge.
+    Yields nothing if the image has no focus keyword.
+    """
+    import MosaicFitsReader as mfr
+    import AnalysisProfiles
+    ffile = mfr.MosaicFitsReader(fname, readData=False)
+    instrument = ffile.getKeyword('INSTRUME')
+    side = 'blue' if "BLU" in instrument else 'red'
+    Focus = ffile.getKeyword('BLUFOCUS' if side == 'blue' else 'REDFOCUS')
+    if Focus == None:
+        return
+    shape = ffile.shape
+    profile = AnalysisProfiles.profileFor(side, ffile.getKeyword('BINNING'), shape)
+    columns = np.array(profile.columns())
+    seam = max(seam // profile.binning[0], 1)
+    for i, x0, data, saturated in ffile.iterAmps():
+        width = data.shape[1]
+        local = columns[(columns >= x0 + seam) & (columns < x0 + width - seam)] - x0
+        yield {'file': fname, 'focus': Focus, 'side': side, 'shape': shape, 'profile': profile, 'amp': i,
+               'columns': list(local + x0), 'detColumns': list(local * profile.binning[0] + ffile.ampDetStarts[i]),
+               'rowOffset': ffile.detRowStart, 'amps': [ffile.ampExts[i]] * len(local),
+               'cuts': data[:, local], 'saturated': saturated[:, local]}
+
+"""
+Per-amplifier version of measureWidths: every amplifier of every file is
+measured on its own (readAmpFrames, measureFrame), with a line index per amplifier
+built from the first file. With workers, the amplifiers of a file are measured
+in parallel by a pool of processes.
+The results are in the same FocusResults format, in detector columns.
+"""
+def measureWidthsPerAmp(files, method='moment', out=None, kernel='reference', workers=None):
+    import concurrent.futures
+    import multiprocessing
+    if out is None:
+        out = FocusResults()
+    lineIndex = {}
+    # not forked from the caller, which may be the multithreaded GUI
+    context = multiprocessing.get_context('forkserver')
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context) if workers else None
+    try:
+        for f in files:
+            print("Attempting to open file %s\n" % f)
+            frames = list(readAmpFrames(f))
+            if pool is None:
+                measured = [measureFrame(frame, lineIndex.get(frame['amp']), method, kernel) for frame in frames]
+            else:
+                measured = list(pool.map(measureFrame, frames, [lineIndex.get(frame['amp']) for frame in frames],
+                                         [method] * len(frames), [kernel] * len(frames)))
+            res = FocusResults()
+            for frame, (ampRes, index) in zip(frames, measured):
+                lineIndex[frame['amp']] = index
+                # one file index for all the amplifiers of the file
+                ampRes.files = []
+                res.extend(ampRes)
+            res.files = [f]
+            out.extend(res)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return out
+
+
+def clipMask(widths, high):
     print(widths)
     median = np.median(widths)
     print(median)
     print(median+high)
-    return widths[np.where(widths<median+high)]
+    return widths<median+high
+
+def absoluteClip(widths, high):
+    return widths[np.where(clipMask(widths, high))]
 
 
 def generatePairs(out):
+    """
+    Returns the (focus, width) arrays to fit.
+    For a FocusResults store these are views, otherwise the
+    list of (focus, widths) tuples is flattened with makePairs.
+    """
+    if isinstance(out, FocusResults):
+        return out.pairs()
     return np.array(list(makePairs(out))).T
 
 
+def aggregatePairs(pairs):
+    """
+    Median width at each focus value.
+    Returns the sorted focus values and the matching medians.
+    """
+    focus, widths = np.asarray(pairs[0]), np.asarray(pairs[1])
+    order = np.lexsort((widths, focus))
+    focus, widths = focus[order], widths[order]
+    values, starts, counts = np.unique(focus, return_index=True, return_counts=True)
+    lo = starts + (counts - 1) // 2
+    hi = starts + counts // 2
+    return values, (widths[lo] + widths[hi]) / 2
+
+
+def fitFocusMap(out, tileSize=1024, minPoints=10):
+    """
+    Fits the best focus separately in square tiles of tileSize unbinned pixels across the detector.
+
+    out: FocusResults from measureWidths, with the positions of each width
+    All the tiles are fitted in one batch: the normal equations of the
+    hyperbola fit (y^2 = Ax^2 + Bx + C) are accumulated per tile and solved together.
+    A plane minX = f0 + tx * x + ty * y is then fitted to the tile results.
+
+    Returns tileX, tileY (tile centers), focus (best focus per tile, nan if the fit failed),
+    and the plane (f0, tx, ty); tx and ty are the tilts in focus units per unbinned pixel.
+    """
+    focus = out.focus
+    widths = out.width.astype(float)
+    xs = out.column
+    ys = out.row
+
+    tx = (xs // tileSize).astype(int)
+    ty = (ys // tileSize).astype(int)
+    nx, ny = tx.max() + 1, ty.max() + 1
+    tile = ty * nx + tx
+    nTiles = nx * ny
+
+    # offset the focus values to keep the normal equations well conditioned
+    f0 = focus.mean()
+    scale = np.ptp(focus) or 1.0
+    u = (focus - f0) / scale
+    w2 = widths * widths
+    powers = np.array([np.bincount(tile, u ** k, minlength=nTiles) for k in range(5)])
+    rhs = np.array([np.bincount(tile, w2 * u ** k, minlength=nTiles) for k in range(3)])
+    count = powers[0]
+    nFocus = np.array([len(set(focus[tile == t])) for t in range(nTiles)])
+
+    # matrix[t, i, j] = sum(u^(4-i-j)) for the coefficients (A, B, C)
+    idx = 4 - np.add.outer(np.arange(3), np.arange(3))
+    matrix = powers[idx].transpose(2, 0, 1)
+    vector = rhs[::-1].T
+    good = (count >= minPoints) & (nFocus >= 3)
+    matrix[~good] = np.eye(3)
+    A, B, C = np.linalg.solve(matrix, vector[..., None])[..., 0].T
+    good &= A > 0
+    minX = np.where(good, f0 - scale * B / np.where(good, 2 * A, 1), np.nan)
+
+    tileX = (np.arange(nx) + 0.5) * tileSize
+    tileY = (np.arange(ny) + 0.5) * tileSize
+    focusMap = minX.reshape(ny, nx)
+
+    gx, gy = np.meshgrid(tileX, tileY)
+    ok = np.isfinite(focusMap)
+    plane = (np.nan, np.nan, np.nan)
+    if ok.sum() >= 3:
+        design = np.array([np.ones(ok.sum()), gx[ok], gy[ok]]).T
+        plane = tuple(np.linalg.lstsq(design, focusMap[ok], rcond=None)[0])
+    return tileX, tileY, focusMap, plane
+
 """
 Fits a hyperbola: x=focus, y=standard deviation
 
@@ -203,3 +664,96 @@ def fitPairs(pairs):
 
 
 
+
+
+def minXError(pairs):
+    """
+    Standard error of the best focus minX = -B/2A, propagated from
+    the covariance matrix of the hyperbola fit.
+    """
+    res, cov = np.polyfit(pairs[0], np.multiply(pairs[1], pairs[1]), deg=2, cov=True)
+    A, B, C = res
+    jac = np.array([B / (2 * A * A), -1 / (2 * A), 0])
+    return math.sqrt(jac @ cov @ jac)
+
+
+def nextFocusPosition(results, center, step, tolerance, minFrames=4, limits=(None, None)):
+    """
+    Decides where to take the next image of an adaptive focus loop.
+
+    The first images are taken at center - step, center, center + step.
+    Then, until the minimum is bracketed (the smallest median width is not at
+    either end of the sampled range) the range is extended by step on the side
+    of the smallest widths. Once bracketed, the hyperbola is fitted and images are
+    added at minX +/- step, on the side with fewer samples, until the error on
+    minX is below tolerance and at least minFrames focus values have been measured.
+    When both are measured already, minX +/- step/2 are tried, then the range
+    is widened by step on each side.
+
+    limits (lowest, highest; None for no limit) are the focus values the
+    mechanism can reach: the positions asked for are clipped to them. When a
+    clipped position has already been measured, the loop cannot go further
+    that way.
+
+    Returns done, next focus, minX, error on minX (None when not available yet).
+    The next focus is None when there is no position left to measure: the loop
+    then ends with the best estimate available, done only if it is accurate enough.
+    """
+    low, high = limits
+
+    def clip(x):
+        if low is not None and x < low:
+            return low
+        if high is not None and x > high:
+            return high
+        return x
+
+    values = results.focusValues()
+
+    def measured(x):
+        return len(values) > 0 and np.abs(values - x).min() <= abs(step) / 10
+
+    for start in (center - step, center, center + step):
+        if not measured(clip(start)):
+            return False, clip(start), None, None
+
+    pairs = results.pairs()
+    fit = np.polyfit(pairs[0], np.multiply(pairs[1], pairs[1]), deg=2) if len(values) >= 3 else None
+
+    def accurate(error):
+        return error < tolerance and len(values) >= minFrames
+
+    def bestSoFar():
+        # the range cannot be extended any more: fitted minimum if there is one, else the narrowest image
+        if fit is not None and fit[0] > 0:
+            error = minXError(pairs)
+            return accurate(error), None, clip(-fit[1] / fit[0] / 2), error
+        return False, None, values[iMin], np.nan
+
+    medians = np.array([np.median(pairs[1][pairs[0] == v]) for v in values])
+    iMin = int(np.argmin(medians))
+    if iMin == 0 or iMin == len(values) - 1:
+        nextFocus = clip(values[0] - step if iMin == 0 else values[-1] + step)
+        if measured(nextFocus):
+            return bestSoFar()
+        return False, nextFocus, None, None
+
+    A, B, C = fit
+    if A <= 0:
+        nextFocus = clip(values[iMin] + step / 2)
+        if measured(nextFocus):
+            return bestSoFar()
+        return False, nextFocus, None, None
+    minX = -B / A / 2
+    error = minXError(pairs)
+    if accurate(error):
+        return True, None, minX, error
+    below = (values < minX).sum()
+    above = (values > minX).sum()
+    sign = -1 if below < above else 1
+    candidates = [minX + sign * step, minX - sign * step, minX + sign * step / 2, minX - sign * step / 2,
+                  values[0] - step, values[-1] + step]
+    for nextFocus in candidates:
+        if not measured(clip(nextFocus)):
+            return False, clip(nextFocus), minX, error
+    return False, None, minX, error